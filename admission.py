@@ -0,0 +1,222 @@
+"""Admission control: load shedding in front of the database-backed routes.
+
+With ADMISSION_CONTROL=1, each process admits at most
+ADMISSION_READ_LIMIT reads (GET, HEAD) and ADMISSION_WRITE_LIMIT writes
+at a time, by default sized from the requests it can serve at once
+(ADMISSION_THREADS). Up to ADMISSION_QUEUE_SIZE more requests of each
+class wait, each for at most ADMISSION_QUEUE_TIMEOUT seconds, for a slot
+to free up. Anything beyond that is answered at once with 503 and
+Retry-After instead of piling up until the server times
+out. When PostgreSQL slows down, clients get quick errors and the
+database gets a bounded load rather than an ever growing one.
+
+With RATE_LIMIT_PER_SUB set, each token subject (the JWT `sub` that
+requires_auth verified) may also make that many requests a second, in
+bursts of up to RATE_LIMIT_BURST; requests over it get 429.
+
+Health, metrics and internal routes, GET /changes (which gives its
+database connection back before streaming) and the POST /batch wrapper
+(whose sub-requests are admitted one by one) are not limited. A limit
+of 0 turns that class's limiter off.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import abort, g, request
+
+import metrics
+from auth.auth import on_authenticated
+from fastjson import json_response
+from metrics import Counter, Histogram, record
+
+
+# Without it the limits are 0 (off) unless set one by one.
+ADMISSION_CONTROL = os.getenv('ADMISSION_CONTROL', '0') == '1'
+# Requests one process serves at once. gunicorn.conf.py and asgi.py set
+# it from the worker class (threads, greenlets or ASGI_THREADS).
+ADMISSION_THREADS = int(os.getenv('ADMISSION_THREADS', 8))
+# A queued request holds a thread too. By default the running and queued
+# requests of both classes take at most three quarters of the threads, so
+# a new request always finds a thread to reach admit() and get its 503
+# instead of waiting in the server's own queue.
+ADMISSION_READ_LIMIT = int(os.getenv(
+    'ADMISSION_READ_LIMIT',
+    max(1, ADMISSION_THREADS * 3 // 8) if ADMISSION_CONTROL else 0))
+ADMISSION_WRITE_LIMIT = int(os.getenv(
+    'ADMISSION_WRITE_LIMIT',
+    max(1, ADMISSION_THREADS // 8) if ADMISSION_CONTROL else 0))
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE',
+                                     ADMISSION_THREADS // 8))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 1))
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', 1))
+RATE_LIMIT_PER_SUB = float(os.getenv('RATE_LIMIT_PER_SUB', 0))
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', 20))
+
+READ_METHODS = ('GET', 'HEAD')
+EXEMPT_RULES = ('/test', '/metrics', '/internal/cache', '/internal/pool',
+                '/changes', '/batch')
+
+rejections = metrics.register(Counter(
+    'admission_rejections_total', 'Requests turned away by admission '
+    'control.', ('route_class', 'reason')))
+queue_wait = metrics.register(Histogram(
+    'admission_queue_seconds', 'Time spent waiting for an admission slot.',
+    ('route_class',)))
+
+
+class Limiter:
+    """Lets `limit` requests run at once. Up to `queue_size` more wait
+    at most `timeout` seconds for a slot; the rest are refused at once."""
+
+    def __init__(self, limit, queue_size=ADMISSION_QUEUE_SIZE,
+                 timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        '''Takes a slot. Returns None, or why none was given:
+        "queue_full" or "timeout"'''
+        with self.condition:
+            # Arrivals queue behind waiters rather than overtaking them.
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                return None
+            if self.waiting >= self.queue_size:
+                return 'queue_full'
+            self.waiting += 1
+            deadline = time.monotonic() + self.timeout
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return 'timeout'
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            return None
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'limit': self.limit,
+                'active': self.active,
+                'waiting': self.waiting,
+            }
+
+
+class TokenBuckets:
+    """One token bucket per key: `rate` tokens a second, holding at most
+    `burst`. The least recently seen keys beyond `maxsize` are dropped,
+    which only ever refills their bucket."""
+
+    def __init__(self, rate, burst, maxsize=10000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key):
+        '''Takes a token for `key`. Returns 0, or the seconds until one
+        will be available'''
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+subject_buckets = TokenBuckets(RATE_LIMIT_PER_SUB, RATE_LIMIT_BURST) \
+    if RATE_LIMIT_PER_SUB > 0 else None
+
+
+def route_class(request):
+    '''"read" or "write" for a limited request, None for an exempt one'''
+    if request.method == 'OPTIONS' or request.url_rule is None or \
+            request.url_rule.rule in EXEMPT_RULES:
+        return None
+    return 'read' if request.method in READ_METHODS else 'write'
+
+
+def reject(status, message, retry_after):
+    response = json_response({
+        "success": False,
+        "message": message,
+        "error": status,
+    }, status)
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def limit_subject(decision):
+    '''Aborts with 429 when the token's subject is over its rate'''
+    if subject_buckets is None:
+        return
+    subject = decision.payload.get('sub')
+    if subject is None:
+        return
+    wait = subject_buckets.take(subject)
+    if wait:
+        rejections.inc(route_class=route_class(request) or '',
+                       reason='rate_limit')
+        abort(reject(429, 'too many requests', wait))
+
+
+on_authenticated(limit_subject)
+
+
+def init_app(app):
+    limiters = {
+        'read': Limiter(ADMISSION_READ_LIMIT),
+        'write': Limiter(ADMISSION_WRITE_LIMIT),
+    }
+    app.extensions['admission'] = limiters
+    metrics.register_stats('admission', lambda: {
+        f'{name}_{key}': value
+        for name, limiter in limiters.items()
+        for key, value in limiter.stats().items()
+    })
+
+    @app.before_request
+    def admit():
+        kind = route_class(request)
+        if kind is None or limiters[kind].limit <= 0:
+            return None
+        limiter = limiters[kind]
+
+        started = time.perf_counter()
+        reason = limiter.acquire()
+        waited = time.perf_counter() - started
+        record('queue', waited)
+        queue_wait.observe(waited, route_class=kind)
+        if reason is not None:
+            rejections.inc(route_class=kind, reason=reason)
+            return reject(503, 'service unavailable', ADMISSION_RETRY_AFTER)
+        g.admission = limiter
+
+    @app.teardown_request
+    def release(error):
+        limiter = g.pop('admission', None)
+        if limiter is not None:
+            limiter.release()
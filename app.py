@@ -1,12 +1,284 @@
 import os
-from flask import Flask, request, abort, jsonify
+import base64
+import binascii
+from functools import partial
+from itertools import islice
+from datetime import datetime
+from flask import Flask, Response, request, abort, jsonify, json, \
+    stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_cors import CORS
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import selectinload
+
+
+from models import db, Movie, Actor, setup_db, bulk_insert, bulk_update, \
+    bulk_delete, get_versions, on_change, flush, init_unit_of_work, \
+    has_pending_changes, DEFER_COMMIT_ENVIRON_KEY
+from auth.auth import AuthError, requires_auth, check_permissions, \
+    jwks_cache, token_cache
+from cache import ResponseCache, backend_from_env
+from pool import pool_status
+import replicas
+from search import search_movies, search_actors
+import admission
+import batch
+import changes
+import compress
+import fastjson
+import metrics
+from fastjson import dumps, json_response
+from metrics import timed
+
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', 20))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 100))
+MAX_BULK_ROWS = int(os.getenv('MAX_BULK_ROWS', 10000))
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 500))
+SEARCH_RESULTS = int(os.getenv('SEARCH_RESULTS', 10))
+MAX_SEARCH_RESULTS = int(os.getenv('MAX_SEARCH_RESULTS', 50))
+# Shorter queries have too few trigrams for the PostgreSQL indexes to
+# narrow down.
+SEARCH_MIN_LENGTH = int(os.getenv('SEARCH_MIN_LENGTH', 3))
+NDJSON = 'application/x-ndjson'
+
+response_cache = ResponseCache(backend_from_env())
+on_change(response_cache.invalidate)
+metrics.register_stats('response_cache', response_cache.stats)
+metrics.register_stats('jwks_cache', jwks_cache.stats)
+metrics.register_stats('token_cache', token_cache.stats)
+metrics.register_stats('pool', lambda: pool_status(db.engine))
+
+
+def encode_cursor(last_id):
+    cursor = base64.urlsafe_b64encode(str(last_id).encode('utf-8'))
+    return cursor.decode('utf-8').rstrip('=')
+
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return int(base64.urlsafe_b64decode(padded.encode('utf-8')))
+
+
+def paginate(request, query, column):
+    '''Keyset pagination on a unique, indexed column.
+
+    Reads `limit` and `cursor` from the query string and returns the rows
+    of the requested page together with the cursor of the next page (None
+    on the last page). Cost per page is constant regardless of table size.
+    '''
+    try:
+        limit = int(request.args.get('limit', PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    cursor = request.args.get('cursor', None)
+    if cursor:
+        try:
+            last_id = decode_cursor(cursor)
+        except (ValueError, binascii.Error):
+            abort(400)
+        query = query.filter(column > last_id)
+
+    rows = query.order_by(column).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].id)
+
+    return rows, next_cursor
+
+
+def parse_fields(request, model):
+    '''The `fields` query parameter as a subset of `model.FIELDS`, in
+    format() order. id is always included; no parameter means every
+    field.'''
+    value = request.args.get('fields', None)
+    if value is None:
+        return model.FIELDS
+
+    fields = {field.strip() for field in value.split(',') if field.strip()}
+    if not fields or not fields <= set(model.FIELDS):
+        abort(400)
+    return tuple(field for field in model.FIELDS
+                 if field in fields or field == 'id')
+
+
+def wants_ndjson(request):
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON])
+    return best == NDJSON
+
+
+def stream_ndjson(query, column, format_rows):
+    '''Streams every row of `query` after the optional `cursor` as NDJSON.
+
+    Rows are pulled from a server-side cursor in batches of
+    STREAM_BATCH_SIZE, turned into dicts by `format_rows` a batch at a time
+    and written out one line at a time, so memory stays flat however large
+    the table is.
+    '''
+    cursor = request.args.get('cursor', None)
+    if cursor:
+        try:
+            query = query.filter(column > decode_cursor(cursor))
+        except (ValueError, binascii.Error):
+            abort(400)
 
+    def generate():
+        rows = iter(query.order_by(column).yield_per(STREAM_BATCH_SIZE))
+        while True:
+            batch = list(islice(rows, STREAM_BATCH_SIZE))
+            if not batch:
+                break
+            for item in format_rows(batch):
+                yield dumps(item) + b'\n'
 
-from models import Movie, Actor, setup_db
-from auth.auth import AuthError, requires_auth
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
+
+
+def current_etag(request, *table_names):
+    '''ETag built from the change versions of the tables a response reads
+    from; any write to one of them produces a new tag.
+
+    None when the request can see uncommitted writes (a transactional
+    POST /batch): the versions only move at commit, so such a response
+    must be neither tagged, matched against If-None-Match nor cached.
+    '''
+    if request.environ.get(DEFER_COMMIT_ENVIRON_KEY) or \
+            has_pending_changes(db.session()):
+        return None
+    versions = get_versions(*table_names)
+    etag = '-'.join(f'{name}.{versions[name]}' for name in table_names)
+    if wants_ndjson(request):
+        etag += '-ndjson'
+    return etag
+
+
+def not_modified(request, etag):
+    '''Returns a 304 response if the client already holds `etag`'''
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        return with_etag(Response(status=304), etag)
+    return None
+
+
+def with_etag(response, etag):
+    if etag is not None:
+        response.set_etag(etag)
+    response.vary.add('Accept')
+    return response
+
+
+def cached_json(request, etag, table_names, build):
+    '''Serves the JSON body for this URL at `etag` from the response cache,
+    calling `build()` for the response dict on a miss. Without an ETag
+    the body is built every time and not cached.'''
+    key = f'{request.full_path}|{etag}'
+    body = response_cache.get(key) if etag is not None else None
+    if body is None:
+        result = build()
+        with timed('serialize'):
+            body = dumps(result)
+        if etag is not None:
+            response_cache.set(key, body, table_names)
+    return with_etag(Response(body, mimetype='application/json'), etag)
+
+
+def read_batch(request):
+    '''Returns the list of objects posted to a bulk endpoint, either as a
+    JSON array or as NDJSON (one object per line)'''
+    if request.mimetype == NDJSON:
+        try:
+            items = [
+                json.loads(line)
+                for line in request.get_data(as_text=True).splitlines()
+                if line.strip()
+            ]
+        except ValueError:
+            abort(400)
+    else:
+        items = request.get_json(silent=True)
+
+    if not isinstance(items, list) or not items:
+        abort(400)
+    if len(items) > MAX_BULK_ROWS:
+        abort(413)
+    if not all(isinstance(item, dict) for item in items):
+        abort(400)
+
+    return items
+
+
+def read_selection(body, model):
+    '''The rows a batch PATCH or DELETE applies to, as a SQL criterion.
+
+    `body` names them either by id, {"ids": [1, 2]}, or with a filter of
+    column equalities, {"filter": {"movie_id": 3}} (a list value matches
+    any of its items). An empty selection is rejected rather than taken to
+    mean the whole table.
+    '''
+    if not isinstance(body, dict):
+        abort(400)
+    ids = body.get('ids', None)
+    where = body.get('filter', None)
+    if (ids is None) == (where is None):
+        abort(400)
+
+    if ids is not None:
+        if not isinstance(ids, list) or not ids or \
+                not all(isinstance(i, int) for i in ids):
+            abort(400)
+        if len(ids) > MAX_BULK_ROWS:
+            abort(413)
+        return model.id.in_(ids)
+
+    if not isinstance(where, dict) or not where:
+        abort(400)
+    criteria = []
+    for field, value in where.items():
+        if field not in model.FIELDS or field == 'actors':
+            abort(400)
+        column = getattr(model, field)
+        if isinstance(value, list):
+            criteria.append(column.in_([parse_value(column, v)
+                                        for v in value]))
+        else:
+            criteria.append(column == parse_value(column, value))
+    return db.and_(*criteria)
+
+
+def read_values(body, model):
+    '''The new column values of a batch PATCH'''
+    values = body.get('values', None)
+    if not isinstance(values, dict):
+        abort(400)
+    if not values:
+        abort(422)
+    for field in values:
+        if field not in model.FIELDS or field in ('id', 'actors'):
+            abort(400)
+    return {field: parse_value(getattr(model, field), value)
+            for field, value in values.items()}
+
+
+def parse_date(value):
+    '''Parses ISO-8601 dates, anything else is left for the database'''
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_value(column, value):
+    '''`value` for `column` as given in a batch selection or PATCH: only
+    DateTime columns have ISO-8601 strings parsed'''
+    if isinstance(column.type, db.DateTime):
+        return parse_date(value)
+    return value
 
 
 def create_app(test_config=None):
@@ -14,6 +286,14 @@ def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app)
     CORS(app)
+    fastjson.init_app(app)
+    metrics.init_app(app)
+    admission.init_app(app)
+    init_unit_of_work(app)
+    replicas.init_app(app, db)
+    compress.init_app(app)
+    changes.init_app(app)
+    batch.init_app(app)
 
     @app.after_request
     def after_request(response):
@@ -26,7 +306,7 @@ def create_app(test_config=None):
             'GET,POST,PATCH,DELETE,OPTIONS'
         )
 
-    return response
+        return response
 
     # Test API
     @app.route('/test')
@@ -36,6 +316,25 @@ def create_app(test_config=None):
             "message": "welcome"
         })
 
+    @app.route('/internal/cache')
+    @requires_auth('get:internal')
+    def cache_stats(payload):
+        return jsonify({
+            "success": True,
+            "cache": response_cache.stats()
+        })
+
+    @app.route('/internal/pool')
+    @requires_auth('get:internal')
+    def pool_stats(payload):
+        result = {
+            "success": True,
+            "pool": pool_status(db.engine)
+        }
+        if 'replicas' in app.extensions:
+            result["replicas"] = app.extensions['replicas'].status()
+        return jsonify(result)
+
     '''
     Endpoints to GET, CREATE, UPDATE and DELETE a movie
     '''
@@ -43,14 +342,54 @@ def create_app(test_config=None):
     @app.route('/movies')
     @requires_auth('get:movies')
     def get_movies(payload):
-        movies_query = Movie.query.all()
+        fields = parse_fields(request, Movie)
+        tables = (Movie.__tablename__,)
+        if 'actors' in fields:
+            tables += (Actor.__tablename__,)
+        etag = current_etag(request, *tables)
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+
+        # Plain rows of only the requested columns rather than ORM
+        # objects; format_rows loads every movie's actors, when asked for,
+        # in one batched IN query.
+        query = Movie.row_query(fields)
+        format_rows = partial(Movie.format_rows, fields=fields)
+        if wants_ndjson(request):
+            return with_etag(stream_ndjson(query, Movie.id, format_rows),
+                             etag)
+
+        def build():
+            movies_query, next_cursor = paginate(request, query, Movie.id)
+
+            movies = format_rows(movies_query)
+
+            return {
+                "success": True,
+                "movies": movies,
+                "next_cursor": next_cursor
+            }
 
-        movies = [movie.format() for movie in movies_query]
+        return cached_json(request, etag, tables, build)
 
-        return jsonify({
+    @app.route('/movies/<int:movie_id>')
+    @requires_auth('get:movies')
+    def get_movie(payload, movie_id):
+        etag = current_etag(request, Movie.__tablename__, Actor.__tablename__)
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+
+        movie = Movie.query.options(selectinload(Movie.actors)) \
+            .filter(Movie.id == movie_id).one_or_none()
+        if movie is None:
+            abort(404)
+
+        return with_etag(jsonify({
             "success": True,
-            "movies": movies
-        })
+            "movie": movie.format()
+        }), etag)
 
     @app.route('/movies', methods=["POST"])
     @requires_auth('post:movie')
@@ -69,7 +408,7 @@ def create_app(test_config=None):
 
         movie = Movie(
             title=title,
-            release_date=release_date
+            release_date=parse_date(release_date)
         )
         movie.insert()
 
@@ -77,6 +416,33 @@ def create_app(test_config=None):
             "success": True,
         })
 
+    @app.route('/movies/bulk', methods=["POST"])
+    @requires_auth('post:movie')
+    def create_movies_bulk(payload):
+        rows = []
+        for item in read_batch(request):
+            title = item.get('title', None)
+            release_date = item.get('release_date', None)
+
+            if title is None or release_date is None:
+                abort(400)
+
+            rows.append({
+                'title': title,
+                'release_date': parse_date(release_date)
+            })
+
+        try:
+            movie_ids = bulk_insert(Movie, rows)
+        except SQLAlchemyError:
+            abort(400)
+
+        return json_response({
+            "success": True,
+            "created_movie_ids": movie_ids,
+            "total_created": len(movie_ids)
+        })
+
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movie')
     def update_movie(payload, movie_id):
@@ -93,7 +459,7 @@ def create_app(test_config=None):
             updated_movie.title = title
 
         if release_date:
-            updated_movie.release_date = release_date
+            updated_movie.release_date = parse_date(release_date)
 
         updated_movie.update()
 
@@ -103,6 +469,24 @@ def create_app(test_config=None):
             "updated_movie_title": updated_movie.title
         })
 
+    @app.route('/movies', methods=['PATCH'])
+    @requires_auth('patch:movie')
+    def update_movies(payload):
+        body = request.get_json(silent=True)
+        criteria = read_selection(body, Movie)
+        values = read_values(body, Movie)
+
+        try:
+            movie_ids = bulk_update(Movie, criteria, values)
+        except SQLAlchemyError:
+            abort(400)
+
+        return json_response({
+            "success": True,
+            "updated_movie_ids": movie_ids,
+            "total_updated": len(movie_ids)
+        })
+
     @app.route('/movies/<int:movie_id>', methods=["DELETE"])
     @requires_auth('delete:movie')
     def delete_movie(payload, movie_id):
@@ -118,6 +502,22 @@ def create_app(test_config=None):
             "deleted_movie_id": movie.id
         })
 
+    @app.route('/movies', methods=['DELETE'])
+    @requires_auth('delete:movie')
+    def delete_movies(payload):
+        criteria = read_selection(request.get_json(silent=True), Movie)
+
+        try:
+            movie_ids = bulk_delete(Movie, criteria)
+        except SQLAlchemyError:
+            abort(400)
+
+        return json_response({
+            "success": True,
+            "deleted_movie_ids": movie_ids,
+            "total_deleted": len(movie_ids)
+        })
+
     '''
         Endpoints to GET, CREATE, UPDATE and DELETE actor
     '''
@@ -125,15 +525,49 @@ def create_app(test_config=None):
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
     def get_actors(payload):
+        fields = parse_fields(request, Actor)
+        tables = (Actor.__tablename__,)
+        etag = current_etag(request, *tables)
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+
+        query = Actor.row_query(fields)
+        format_rows = partial(Actor.format_rows, fields=fields)
+        if wants_ndjson(request):
+            return with_etag(stream_ndjson(query, Actor.id, format_rows),
+                             etag)
+
+        def build():
+            actors_query, next_cursor = paginate(request, query, Actor.id)
+
+            with timed('serialize'):
+                actors = format_rows(actors_query)
+
+            return {
+                "success": True,
+                "actors": actors,
+                "next_cursor": next_cursor
+            }
 
-        actors_query = Actor.query.order_by(Actor.id).all()
+        return cached_json(request, etag, tables, build)
 
-        actors = [actor.format() for actor in actors_query]
+    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_actor(payload, actor_id):
+        etag = current_etag(request, Actor.__tablename__)
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
 
-        return jsonify({
+        actor = Actor.query.get(actor_id)
+        if actor is None:
+            abort(404)
+
+        return with_etag(jsonify({
             "success": True,
-            "actors": actors
-        })
+            "actor": actor.format()
+        }), etag)
 
     @app.route('/actors', methods=["POST"])
     @requires_auth('post:actor')
@@ -164,6 +598,38 @@ def create_app(test_config=None):
             "success": True,
         })
 
+    @app.route('/actors/bulk', methods=["POST"])
+    @requires_auth('post:actor')
+    def create_actors_bulk(payload):
+        rows = []
+        for item in read_batch(request):
+            name = item.get('name', None)
+            age = item.get('age', None)
+            gender = item.get('gender', None)
+            movie_id = item.get('movie_id', None)
+
+            if name is None or age is None or gender is None \
+                    or movie_id is None:
+                abort(400)
+
+            rows.append({
+                'name': name,
+                'age': age,
+                'gender': gender,
+                'movie_id': movie_id
+            })
+
+        try:
+            actor_ids = bulk_insert(Actor, rows)
+        except SQLAlchemyError:
+            abort(400)
+
+        return json_response({
+            "success": True,
+            "created_actor_ids": actor_ids,
+            "total_created": len(actor_ids)
+        })
+
     @app.route('/actors/<int:actor_id>', methods=["PATCH"])
     @requires_auth('patch:actor')
     def update_actor(payload, actor_id):
@@ -194,6 +660,7 @@ def create_app(test_config=None):
 
         try:
             actor.update()
+            flush()
         except:
             abort(400)
 
@@ -203,6 +670,24 @@ def create_app(test_config=None):
             "updated_actor_name": actor.name
         })
 
+    @app.route('/actors', methods=['PATCH'])
+    @requires_auth('patch:actor')
+    def update_actors(payload):
+        body = request.get_json(silent=True)
+        criteria = read_selection(body, Actor)
+        values = read_values(body, Actor)
+
+        try:
+            actor_ids = bulk_update(Actor, criteria, values)
+        except SQLAlchemyError:
+            abort(400)
+
+        return json_response({
+            "success": True,
+            "updated_actor_ids": actor_ids,
+            "total_updated": len(actor_ids)
+        })
+
     @app.route('/actors/<int:actor_id>', methods=["DELETE"])
     @requires_auth('delete:actor')
     def delete_actor(payload, actor_id):
@@ -213,6 +698,7 @@ def create_app(test_config=None):
 
         try:
             actor.delete()
+            flush()
 
             return jsonify({
                 "success": True,
@@ -221,6 +707,64 @@ def create_app(test_config=None):
         except Exception:
             abort(500)
 
+    @app.route('/actors', methods=['DELETE'])
+    @requires_auth('delete:actor')
+    def delete_actors(payload):
+        criteria = read_selection(request.get_json(silent=True), Actor)
+
+        try:
+            actor_ids = bulk_delete(Actor, criteria)
+        except SQLAlchemyError:
+            abort(400)
+
+        return json_response({
+            "success": True,
+            "deleted_actor_ids": actor_ids,
+            "total_deleted": len(actor_ids)
+        })
+
+    '''
+        Endpoint to search movie titles and actor names
+    '''
+
+    @app.route('/search')
+    @requires_auth(('get:movies', 'get:actors'))
+    def search(payload):
+        q = request.args.get('q', '').strip()
+        kind = request.args.get('type', 'all')
+        if not q or kind not in ('all', 'movies', 'actors'):
+            abort(400)
+        if db.engine.dialect.name == 'postgresql' and \
+                len(q) < SEARCH_MIN_LENGTH:
+            abort(400)
+
+        try:
+            limit = int(request.args.get('limit', SEARCH_RESULTS))
+        except ValueError:
+            abort(400)
+        if limit < 1:
+            abort(400)
+        limit = min(limit, MAX_SEARCH_RESULTS)
+
+        # type=all searches whichever of the tables the token can read.
+        if kind == 'all':
+            kinds = [table for table in ('movies', 'actors')
+                     if f'get:{table}' in payload['permissions']]
+        else:
+            check_permissions(f'get:{kind}', payload)
+            kinds = [kind]
+
+        result = {
+            "success": True,
+            "query": q
+        }
+        if 'movies' in kinds:
+            result["movies"] = search_movies(q, limit)
+        if 'actors' in kinds:
+            result["actors"] = search_actors(q, limit)
+
+        return json_response(result)
+
     # Error Handlers
     @app.errorhandler(400)
     def bad_request(error):
@@ -238,6 +782,14 @@ def create_app(test_config=None):
             "error": 404,
         }), 404
 
+    @app.errorhandler(413)
+    def too_large(error):
+        return jsonify({
+            "success": False,
+            "message": "request entity too large",
+            "error": 413,
+        }), 413
+
     @app.errorhandler(422)
     def not_found(error):
         return jsonify({
@@ -252,7 +804,7 @@ def create_app(test_config=None):
             "success": False,
             "error": auth_error.status_code,
             "message": auth_error.error['description']
-        })
+        }), auth_error.status_code
 
     @app.errorhandler(500)
     def internal_error(error):
@@ -264,7 +816,6 @@ def create_app(test_config=None):
 
     return app
 
-app = create_app()
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=80, debug=True)
+    create_app().run(host='0.0.0.0', port=80, debug=True)
@@ -0,0 +1,48 @@
+"""ASGI entry point for the casting API.
+
+    uvicorn --factory asgi:create_asgi_app --workers 2
+
+The app is served through a2wsgi's WSGIMiddleware. The event loop owns
+the sockets: it accepts connections and writes responses, so idle
+keep-alives and slow clients cost a coroutine rather than a worker. Each
+request's Flask handler (the same routes, error handlers and
+requires_auth checks as app.py) runs on a pool of ASGI_THREADS threads.
+Streamed responses go back to the loop through a queue of at most
+ASGI_SEND_QUEUE_SIZE chunks, so a slow client holds up its handler
+instead of having the whole body buffered for it.
+
+The handlers stay synchronous: every route is built on Flask-SQLAlchemy's
+session, so this is the same thread-per-request model as gunicorn's
+gthread workers, with the connection handling moved onto the loop.
+"""
+import os
+
+from a2wsgi import WSGIMiddleware
+
+
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', 32))
+ASGI_SEND_QUEUE_SIZE = int(os.getenv('ASGI_SEND_QUEUE_SIZE', 8))
+# admission.py sizes its default limits from this when it is imported.
+os.environ.setdefault('ADMISSION_THREADS', str(ASGI_THREADS))
+
+from app import create_app  # noqa: E402
+from warmup import warm_up  # noqa: E402
+
+
+def to_asgi(flask_app, threads=ASGI_THREADS):
+    '''`flask_app` as an ASGI app running handlers on `threads` threads'''
+    def wsgi_app(environ, start_response):
+        # wsgi.input ends with the request body, so chunked uploads (no
+        # Content-Length) can be read too.
+        environ['wsgi.input_terminated'] = True
+        return flask_app(environ, start_response)
+
+    return WSGIMiddleware(wsgi_app, workers=threads,
+                          send_queue_size=ASGI_SEND_QUEUE_SIZE)
+
+
+def create_asgi_app():
+    '''The app served over ASGI, warmed up before it takes requests'''
+    flask_app = create_app()
+    warm_up(flask_app)
+    return to_asgi(flask_app)
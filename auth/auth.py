@@ -1,17 +1,37 @@
-from flask import Flask, request, abort
-import json
+from flask import request, abort, g
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
 import os
 
+from metrics import timed
+from .jwks import JWKSCache
+from .token_cache import TokenCache
 
-app = Flask(__name__)
 
 AUTH0_DOMAIN = "dev-xcke28sy.us.auth0.com"
 ALGORITHMS = ['RS256']
 API_AUDIENCE = "casting"
 
+jwks_cache = JWKSCache(
+    os.getenv('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'),
+    ttl=int(os.getenv('JWKS_CACHE_TTL', 600)),
+    fetch_timeout=float(os.getenv('JWKS_FETCH_TIMEOUT', 5)),
+)
+token_cache = TokenCache(maxsize=int(os.getenv('TOKEN_CACHE_SIZE', 1024)))
+jwks_cache.on_rotate(token_cache.clear)
+
+# WSGI environ key under which POST /batch hands its sub-requests the
+# already verified Decision. Unlike headers, clients cannot set it.
+DECISION_ENVIRON_KEY = 'casting.auth_decision'
+
+# Callables run with the Decision of every request requires_auth lets
+# through, before its permission check; they may abort the request.
+auth_listeners = []
+
+
+def on_authenticated(listener):
+    auth_listeners.append(listener)
+
 
 class AuthError(Exception):
     def __init__(self, error, status_code):
@@ -53,34 +73,25 @@ def get_token_auth_header():
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    with timed('jwks'):
+        rsa_key = jwks_cache.get_key(unverified_header['kid'])
     if rsa_key:
         try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
+            with timed('jwt'):
+                payload = jwt.decode(
+                    token,
+                    rsa_key,
+                    algorithms=ALGORITHMS,
+                    audience=API_AUDIENCE,
+                    issuer='https://' + AUTH0_DOMAIN + '/'
+                )
 
             return payload
 
@@ -105,14 +116,17 @@ def verify_decode_jwt(token):
                 'description': 'Unable to find the appropriate key.'
             }, 400)
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, permissions=None):
     if 'permissions' not in payload:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT'
         }, 400)
-    
-    if permission not in payload['permissions']:
+
+    if permissions is None:
+        permissions = payload['permissions']
+
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found'
@@ -120,18 +134,49 @@ def check_permissions(permission, payload):
 
     return True
 
+def authenticate():
+    '''Returns the Decision for the request's bearer token, verifying it
+    unless the token cache or an enclosing POST /batch already did'''
+    decision = request.environ.get(DECISION_ENVIRON_KEY)
+    if decision is not None:
+        return decision
+
+    token = get_token_auth_header()
+    decision = token_cache.get(token)
+    if decision is None:
+        try:
+            payload = verify_decode_jwt(token)
+        except:
+            abort(401)
+        decision = token_cache.put(token, payload)
+    return decision
+
+def check_any_permission(needed, payload, permissions=None):
+    '''check_permissions for a route that any one of `needed` lets in'''
+    granted = payload.get('permissions', ()) if permissions is None \
+        else permissions
+    if any(permission in granted for permission in needed[1:]):
+        return True
+    return check_permissions(needed[0], payload, permissions)
+
+
 def requires_auth(permission=''):
+    '''`permission` may be a tuple, any one of which admits the request;
+    the view then checks the ones each part of its response needs.'''
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except:
-                abort(401)
-
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            any_of = isinstance(permission, tuple)
+            g.permission = ','.join(permission) if any_of else permission
+            with timed('auth'):
+                decision = authenticate()
+                for listener in auth_listeners:
+                    listener(decision)
+
+                check = check_any_permission if any_of \
+                    else check_permissions
+                check(permission, decision.payload, decision.permissions)
+            return f(decision.payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,173 @@
+import json
+import re
+import threading
+import time
+from urllib.request import urlopen
+
+from jose import jwk
+
+
+ALGORITHM = 'RS256'
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
+
+class JWKSCache:
+    """Process-wide store of the IdP signing keys, indexed by `kid`.
+
+    Keys are fetched once and reused until they expire (the Cache-Control
+    max-age of the JWKS response, or `ttl` when the IdP sends none).
+    Shortly before expiry a background refresh is started so requests never
+    wait on the IdP, and an unknown `kid` triggers at most one refetch per
+    `min_refetch_interval` no matter how many requests are asking. A fetch
+    gives up after `fetch_timeout` seconds; the keys already held are then
+    served until the IdP answers again.
+    """
+
+    def __init__(self, url, ttl=600, refresh_ahead=60,
+                 min_refetch_interval=30, fetch=None, fetch_timeout=5):
+        self.url = url
+        self.ttl = ttl
+        self.fetch_timeout = fetch_timeout
+        self.refresh_ahead = refresh_ahead
+        self.min_refetch_interval = min_refetch_interval
+        self.fetch = fetch or self.fetch_jwks
+
+        self.keys = {}
+        self.expires_at = 0
+        self.fetched_at = 0
+        self.generation = 0
+        self.refreshing = False
+        self.rotation_listeners = []
+
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    def fetch_jwks(self):
+        '''Fetches the JWKS document, returns (jwks, max_age or None)'''
+        # Requests whose keys expired wait on this fetch (fetch_lock), so
+        # a hung IdP must not hold them for longer than the timeout.
+        response = urlopen(self.url, timeout=self.fetch_timeout)
+        jwks = json.loads(response.read())
+        max_age = None
+        cache_control = response.headers.get('Cache-Control', '')
+        if 'no-store' in cache_control or 'no-cache' in cache_control:
+            max_age = 0
+        else:
+            match = MAX_AGE_RE.search(cache_control)
+            if match:
+                max_age = int(match.group(1))
+        return jwks, max_age
+
+    def get_key(self, kid):
+        '''Returns the verification key for `kid`, or None if the IdP
+        does not know it'''
+        now = time.monotonic()
+        with self.lock:
+            key = self.keys.get(kid)
+            expired = now >= self.expires_at
+            # Refresh ahead by at most half the key set's lifetime, so a
+            # short IdP max-age does not make every hit look stale.
+            refresh_ahead = min(self.refresh_ahead,
+                                (self.expires_at - self.fetched_at) / 2)
+            stale = now >= self.expires_at - refresh_ahead
+            if key is not None and not expired:
+                self.hits += 1
+                if stale and not self.refreshing:
+                    self.refreshing = True
+                    threading.Thread(
+                        target=self._background_refresh, daemon=True
+                    ).start()
+                return key
+            self.misses += 1
+            generation = self.generation
+            recently_fetched = now - self.fetched_at < \
+                self.min_refetch_interval
+
+        if key is None and not expired and recently_fetched:
+            # Unknown kid but the key set is fresh; don't hammer the IdP
+            # with garbage tokens.
+            return None
+
+        self.refresh(generation)
+        with self.lock:
+            return self.keys.get(kid)
+
+    def refresh(self, generation=None):
+        '''Refetches the key set. Concurrent callers that observed the same
+        `generation` share a single fetch.'''
+        with self.fetch_lock:
+            if generation is not None and generation != self.generation:
+                return
+            try:
+                jwks, max_age = self.fetch()
+            except Exception:
+                with self.lock:
+                    self.errors += 1
+                    self.generation += 1
+                    # Keep serving the keys we have if the IdP is down,
+                    # and back off before trying it again.
+                    if not self.keys:
+                        raise
+                    self.expires_at = max(
+                        self.expires_at,
+                        time.monotonic() + self.min_refetch_interval
+                    )
+                return
+
+            keys = {}
+            for key in jwks.get('keys', []):
+                if 'kid' not in key or key.get('kty') != 'RSA':
+                    continue
+                keys[key['kid']] = jwk.construct(key, ALGORITHM)
+
+            ttl = self.ttl if max_age is None else max_age
+            now = time.monotonic()
+            with self.lock:
+                rotated = self.keys.keys() - keys.keys()
+                self.keys = keys
+                self.fetched_at = now
+                self.expires_at = now + ttl
+                self.generation += 1
+                self.refreshes += 1
+
+            if rotated:
+                for listener in self.rotation_listeners:
+                    listener()
+
+    def on_rotate(self, listener):
+        '''Registers a callable run whenever a previously served key is
+        withdrawn by the IdP'''
+        self.rotation_listeners.append(listener)
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            pass
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def clear(self):
+        with self.lock:
+            self.keys = {}
+            self.expires_at = 0
+            self.fetched_at = 0
+            self.generation += 1
+        for listener in self.rotation_listeners:
+            listener()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'errors': self.errors,
+                'keys': len(self.keys),
+            }
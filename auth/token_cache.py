@@ -0,0 +1,87 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+
+Decision = namedtuple('Decision', ['payload', 'permissions', 'expires_at'])
+
+
+def token_key(token):
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+class TokenCache:
+    """Bounded LRU of tokens that already passed signature verification.
+
+    Entries are keyed by a hash of the raw token (the token itself is never
+    kept) and live until the token's `exp` claim, so a client re-sending the
+    same bearer token skips RS256 verification entirely. Tokens without an
+    `exp` are never cached.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, token):
+        '''Returns the cached Decision for `token`, or None'''
+        key = token_key(token)
+        with self.lock:
+            decision = self.entries.get(key)
+            if decision is None:
+                self.misses += 1
+                return None
+            if decision.expires_at <= time.time():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return decision
+
+    def put(self, token, payload):
+        '''Caches a verified payload, returns its Decision'''
+        decision = Decision(
+            payload=payload,
+            permissions=frozenset(payload.get('permissions', ())),
+            expires_at=payload.get('exp'),
+        )
+        if self.maxsize <= 0 or not isinstance(decision.expires_at,
+                                               (int, float)):
+            return decision
+
+        key = token_key(token)
+        with self.lock:
+            self.entries[key] = decision
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return decision
+
+    def clear(self):
+        '''Drops every cached decision, e.g. after a signing key rotation'''
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+            }
@@ -0,0 +1,202 @@
+"""POST /batch: several API calls in one round trip.
+
+    {"transaction": true,
+     "requests": [
+        {"method": "GET", "path": "/movies?limit=5"},
+        {"method": "GET", "path": "/actors/3"},
+        {"method": "PATCH", "path": "/actors/3", "body": {"age": 41}}]}
+
+Each sub-request is dispatched to the existing route as if it had been
+sent on its own, and the response lists their statuses and JSON bodies
+in order. The bearer token is verified once for the whole batch; every
+sub-request still has its route's permission checked against it.
+
+Consecutive GETs do not depend on each other and run concurrently on up
+to BATCH_READ_THREADS threads, each with its own session. Writes run one
+at a time in order and commit on their own, as separate requests would;
+reads after a write wait for it and go to the primary database.
+
+With "transaction": true everything runs in order in the batch's session,
+so reads see the uncommitted writes before them. The first sub-request
+to fail rolls the whole batch back and the ones after it are not run
+(424); otherwise the batch commits once.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import abort, current_app, g, has_app_context, request
+from werkzeug.exceptions import InternalServerError
+from werkzeug.test import EnvironBuilder
+
+from auth.auth import DECISION_ENVIRON_KEY, authenticate
+from fastjson import json_response
+from metrics import timed
+from models import db, DEFER_COMMIT_ENVIRON_KEY
+from replicas import READ_PRIMARY_ENVIRON_KEY, WROTE_ENVIRON_KEY
+
+
+MAX_BATCH_REQUESTS = int(os.getenv('MAX_BATCH_REQUESTS', 20))
+BATCH_READ_THREADS = int(os.getenv('BATCH_READ_THREADS', 4))
+METHODS = ('GET', 'POST', 'PATCH', 'DELETE')
+READ_METHODS = ('GET',)
+# Streams and batches would tie up the batch or recurse into it.
+EXCLUDED_PATHS = ('/batch', '/changes', '/metrics')
+# Copied from the batch to its sub-requests, so that they are routed to
+# the primary after the client's recent writes as its own requests are.
+FORWARDED_ENVIRON_KEYS = ('HTTP_AUTHORIZATION', 'HTTP_COOKIE')
+
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_executor():
+    '''The read pool, created on first use so no threads exist before
+    a forking server starts its workers'''
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(BATCH_READ_THREADS,
+                                          thread_name_prefix='batch')
+        return executor
+
+
+def read_requests(body):
+    '''Validates the batch body, returns its list of sub-requests'''
+    if not isinstance(body, dict) or \
+            not isinstance(body.get('requests'), list) or \
+            not isinstance(body.get('transaction', False), bool):
+        abort(400)
+    items = body['requests']
+    if len(items) > MAX_BATCH_REQUESTS:
+        abort(413)
+    for item in items:
+        if not isinstance(item, dict) or \
+                str(item.get('method', '')).upper() not in METHODS or \
+                not isinstance(item.get('path'), str) or \
+                not item['path'].startswith('/') or \
+                item['path'].split('?', 1)[0].rstrip('/') in EXCLUDED_PATHS:
+            abort(400)
+    return items
+
+
+def dispatch(app, item, environ_overrides):
+    '''Runs one sub-request through the app's full request handling and
+    returns its {"status", "body"} entry'''
+    builder = EnvironBuilder(
+        path=item['path'],
+        method=item['method'].upper(),
+        json=item.get('body'),
+    )
+    try:
+        environ = builder.get_environ()
+    finally:
+        builder.close()
+    environ.update(environ_overrides)
+
+    # On the batch's own thread the sub-request reuses its app context,
+    # and with it the session and flask.g; give it a g of its own.
+    saved = vars(g).copy() if has_app_context() else None
+    if saved is not None:
+        vars(g).clear()
+    try:
+        with app.request_context(environ):
+            try:
+                response = app.full_dispatch_request()
+            except Exception as e:
+                app.log_exception((type(e), e, e.__traceback__))
+                response = app.finalize_request(
+                    app.handle_http_exception(
+                        InternalServerError(original_exception=e)),
+                    from_error_handler=True)
+            if response.is_json:
+                body = response.get_json()
+            else:
+                body = response.get_data(as_text=True) or None
+    finally:
+        if saved is not None:
+            vars(g).clear()
+            vars(g).update(saved)
+    return {'status': response.status_code, 'body': body}
+
+
+def skipped():
+    return {'status': 424, 'body': {
+        'success': False,
+        'message': 'failed dependency',
+        'error': 424,
+    }}
+
+
+def run_batch(app, items, decision, transaction, forwarded=None):
+    '''Dispatches `items` with the `forwarded` environ entries and
+    returns their entries in order and whether they all succeeded'''
+    environ = dict(forwarded or {}, **{DECISION_ENVIRON_KEY: decision})
+    if transaction:
+        environ[DEFER_COMMIT_ENVIRON_KEY] = True
+        # The batch marks the client once it knows the writes committed.
+        environ[WROTE_ENVIRON_KEY] = False
+        results = []
+        for item in items:
+            results.append(dispatch(app, item, environ))
+            if results[-1]['status'] >= 400:
+                db.session.rollback()
+                results += [skipped() for _ in items[len(results):]]
+                return results, False
+            if item['method'].upper() not in READ_METHODS:
+                environ[READ_PRIMARY_ENVIRON_KEY] = True
+        return results, True
+
+    results = [None] * len(items)
+    reads = []
+
+    def run_reads():
+        if len(reads) > 1:
+            futures = [(i, get_executor().submit(dispatch, app, item,
+                                                 dict(environ)))
+                       for i, item in reads]
+            for i, future in futures:
+                results[i] = future.result()
+        elif reads:
+            i, item = reads[0]
+            results[i] = dispatch(app, item, environ)
+        reads.clear()
+
+    for i, item in enumerate(items):
+        if item['method'].upper() in READ_METHODS:
+            reads.append((i, item))
+        else:
+            run_reads()
+            results[i] = dispatch(app, item, environ)
+            environ[READ_PRIMARY_ENVIRON_KEY] = True
+    run_reads()
+    return results, all(r['status'] < 400 for r in results)
+
+
+def init_app(app):
+    @app.route('/batch', methods=['POST'])
+    def batch():
+        with timed('auth'):
+            decision = authenticate()
+        body = request.get_json(silent=True)
+        items = read_requests(body)
+        transaction = body.get('transaction', False)
+
+        forwarded = {key: request.environ[key]
+                     for key in FORWARDED_ENVIRON_KEYS
+                     if key in request.environ}
+        results, success = run_batch(current_app._get_current_object(),
+                                     items, decision, transaction,
+                                     forwarded)
+        # Only a write that took effect sends the client to the primary.
+        request.environ[WROTE_ENVIRON_KEY] = (success or not transaction) \
+            and any(item['method'].upper() not in READ_METHODS and
+                    entry['status'] < 400
+                    for item, entry in zip(items, results))
+        result = {
+            "success": success,
+            "responses": results,
+        }
+        if transaction:
+            result["committed"] = success
+        return json_response(result)
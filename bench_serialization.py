@@ -0,0 +1,107 @@
+"""Microbenchmark for the list endpoints' serialization path.
+
+Compares the old path (ORM objects, format(), Flask's jsonify) with the
+current one (column rows, format_rows(), fastjson.dumps) on a page of
+movies and actors from an in-memory SQLite catalog:
+
+    python bench_serialization.py --rows 1000 --repeat 50
+
+`encode` times JSON encoding alone; `rows to body` also includes loading
+and formatting the rows.
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+from flask import jsonify
+from sqlalchemy.orm import selectinload
+
+import fastjson
+from app import create_app
+from models import db, Movie, Actor
+
+
+def best_of(repeat, function):
+    '''Fastest of `repeat` runs of `function`, in seconds'''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def seed(rows):
+    db.session.execute(Movie.__table__.insert(), [
+        {'title': f'Movie {i}', 'release_date': datetime(2000, 1, 1)}
+        for i in range(rows)
+    ])
+    db.session.execute(Actor.__table__.insert(), [
+        {'name': f'Actor {i}', 'age': 20 + i % 60, 'gender': 'MF'[i % 2],
+         'movie_id': i % rows + 1}
+        for i in range(rows * 3)
+    ])
+    db.session.commit()
+
+
+def cases(rows):
+    def old_movies():
+        movies = Movie.query.options(selectinload(Movie.actors)) \
+            .order_by(Movie.id).limit(rows).all()
+        return [movie.format() for movie in movies]
+
+    def new_movies():
+        return Movie.format_rows(
+            Movie.row_query().order_by(Movie.id).limit(rows))
+
+    def old_actors():
+        actors = Actor.query.order_by(Actor.id).limit(rows).all()
+        return [actor.format() for actor in actors]
+
+    def new_actors():
+        return Actor.format_rows(
+            Actor.row_query().order_by(Actor.id).limit(rows))
+
+    return [('movies', old_movies, new_movies),
+            ('actors', old_actors, new_actors)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='rows per page')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    os.environ['DATABASE_URL'] = 'sqlite://'
+    app = create_app()
+    with app.test_request_context():
+        db.create_all()
+        seed(args.rows)
+
+        print('json backend: %s' % (
+            'orjson' if fastjson.orjson else 'stdlib'))
+        print('%-8s %-14s %10s %10s %8s' % ('list', 'stage', 'before',
+                                             'after', 'speedup'))
+        for name, old, new in cases(args.rows):
+            db.session.expire_all()
+            payload = {'success': True, name: old()}
+            stages = [
+                ('encode',
+                 lambda: jsonify(payload).get_data(),
+                 lambda: fastjson.dumps(payload)),
+                ('rows to body',
+                 lambda: jsonify({'success': True, name: old()}).get_data(),
+                 lambda: fastjson.dumps({'success': True, name: new()})),
+            ]
+            for stage, before, after in stages:
+                slow = best_of(args.repeat, before)
+                fast = best_of(args.repeat, after)
+                print('%-8s %-14s %8.2fms %8.2fms %7.1fx' % (
+                    name, stage, slow * 1000, fast * 1000, slow / fast))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
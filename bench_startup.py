@@ -0,0 +1,135 @@
+"""Startup-time benchmark for the casting API.
+
+Each run is a fresh interpreter that imports app.py, builds the app with
+create_app(), optionally warms it up (warmup.py) and then serves two
+GET /movies requests, timing every step. Runs alternate with and without
+warm-up against the same seeded SQLite file and a local JWKS stub:
+
+    python bench_startup.py --runs 5
+    python bench_startup.py --max-import-ms 1500 --max-create-ms 100
+
+With the --max-* options the script exits non-zero when the median of a
+step is slower, or when importing app.py pulls in Alembic, so it can
+guard against startup regressions in CI.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+STEPS = ('import', 'create_app', 'jwks', 'connections', 'queries',
+         'first_request', 'second_request')
+
+
+def child():
+    '''One cold start; prints its timings as JSON'''
+    started = time.perf_counter()
+    import app
+    timings = {'import': time.perf_counter() - started}
+    heavy = sorted(name for name in ('alembic', 'flask_migrate')
+                   if name in sys.modules)
+
+    from benchmark import JWKSStub
+    from auth import auth
+    from warmup import warm_up, WARMUP
+
+    stub = JWKSStub()
+    auth.jwks_cache.url = stub.url
+    token = stub.mint('https://' + auth.AUTH0_DOMAIN + '/',
+                      auth.API_AUDIENCE, 'bench|startup')
+
+    started = time.perf_counter()
+    flask_app = app.create_app()
+    timings['create_app'] = time.perf_counter() - started
+    timings.update(warm_up(flask_app))
+
+    client = flask_app.test_client()
+    headers = {'Authorization': 'Bearer ' + token}
+    for step in ('first_request', 'second_request'):
+        started = time.perf_counter()
+        response = client.get('/movies', headers=headers)
+        timings[step] = time.perf_counter() - started
+        assert response.status_code == 200, response.status_code
+
+    print(json.dumps({'warmup': WARMUP, 'timings': timings,
+                      'heavy_imports': heavy}))
+
+
+def run_child(database_url, warmup):
+    env = dict(os.environ, DATABASE_URL=database_url,
+               WARMUP='1' if warmup else '0')
+    output = subprocess.run(
+        [sys.executable, __file__, '--child'], env=env, check=True,
+        capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def seed_database(path):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + path
+    from app import create_app
+    from benchmark import seed
+    from models import db
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        seed(1000)
+    return os.environ['DATABASE_URL']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='cold starts with and without warm-up each')
+    parser.add_argument('--max-import-ms', type=float, default=None)
+    parser.add_argument('--max-create-ms', type=float, default=None)
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        return child()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database_url = seed_database(os.path.join(tmpdir, 'startup.db'))
+        results = {True: [], False: []}
+        for _ in range(args.runs):
+            for warmup in (False, True):
+                results[warmup].append(run_child(database_url, warmup))
+
+    print('%-16s %12s %12s' % ('step (median)', 'cold', 'warmed up'))
+    medians = {}
+    for step in STEPS:
+        row = []
+        for warmup in (False, True):
+            samples = [run['timings'][step] for run in results[warmup]
+                       if step in run['timings']]
+            median = statistics.median(samples) if samples else None
+            medians[step, warmup] = median
+            row.append('%10.1fms' % (median * 1000) if samples else
+                       '%12s' % '-')
+        print('%-16s %s %s' % (step, row[0], row[1]))
+
+    failures = []
+    heavy = sorted({name for runs in results.values() for run in runs
+                    for name in run['heavy_imports']})
+    if heavy:
+        failures.append('importing app.py loads ' + ', '.join(heavy))
+    for step, limit in (('import', args.max_import_ms),
+                        ('create_app', args.max_create_ms)):
+        median = medians[step, False]
+        if limit is not None and median * 1000 > limit:
+            failures.append('%s took %.1fms, over the %.1fms limit' % (
+                step, median * 1000, limit))
+    for failure in failures:
+        print('FAIL: ' + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
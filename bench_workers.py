@@ -0,0 +1,164 @@
+"""Compares gunicorn worker models on the same workload.
+
+Seeds a SQLite catalog, starts a JWKS stub, and then for each mode runs
+gunicorn with gunicorn.conf.py (configured through the same environment
+variables as production) and drives the read endpoints with benchmark.py:
+
+    python bench_workers.py --actors 10000 --concurrency 32 --requests 1000
+    python bench_workers.py --modes sync,gthread --db-latency-ms 5
+
+Production requests mostly wait on PostgreSQL and Auth0, which a local
+SQLite file does not. --db-latency-ms adds a sleep before every statement
+to stand in for that network round trip, which is the case the worker
+model matters for. Modes whose worker class is not installed (gevent)
+are skipped.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.request import urlopen
+
+
+MODES = {
+    'sync': {'GUNICORN_WORKER_CLASS': 'sync'},
+    'gthread': {'GUNICORN_WORKER_CLASS': 'gthread'},
+    'gthread-no-preload': {'GUNICORN_WORKER_CLASS': 'gthread',
+                           'GUNICORN_PRELOAD': '0'},
+    'gevent': {'GUNICORN_WORKER_CLASS': 'gevent'},
+}
+READ_ROUTES = 'GET /movies,GET /movies/<id>,GET /actors,GET /actors/<id>'
+
+
+def serve():
+    '''gunicorn app factory: the wsgi.py app, with BENCH_DB_LATENCY_MS of
+    simulated network latency before every statement'''
+    from sqlalchemy import event
+    import wsgi
+    from warmup import app_engines
+
+    latency = float(os.getenv('BENCH_DB_LATENCY_MS', 0)) / 1000
+    if latency:
+        for engine in app_engines(wsgi.app):
+            event.listen(engine, 'before_cursor_execute',
+                         lambda *args: time.sleep(latency))
+    return wsgi.app
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited with %d' % process.returncode)
+        try:
+            with urlopen(base_url + '/test') as response:
+                response.read()
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn did not start in %ds' % timeout)
+
+
+def run_mode(mode, args, env, tokens, movies):
+    import benchmark
+
+    port = free_port()
+    base_url = 'http://127.0.0.1:%d' % port
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--bind', '127.0.0.1:%d' % port,
+         '--log-level', 'warning', 'bench_workers:serve()'],
+        env=dict(env, **MODES[mode]))
+    try:
+        wait_until_up(base_url, process)
+        ready = time.perf_counter() - started
+        results = {}
+        wanted = args.routes.split(',')
+        for name, method, path, body in benchmark.routes(movies,
+                                                         args.actors):
+            if name in wanted:
+                results[name] = benchmark.run_route(
+                    base_url, tokens, method, path, body,
+                    args.concurrency, args.requests)
+        return ready, results
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='requests per route')
+    parser.add_argument('--routes', default=READ_ROUTES,
+                        help='comma separated route names')
+    parser.add_argument('--db-latency-ms', type=float, default=0)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='WEB_CONCURRENCY for every mode')
+    parser.add_argument('--output', default=None,
+                        help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix='casting-bench-')
+    database_url = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+    os.environ['DATABASE_URL'] = database_url
+
+    from app import create_app
+    from auth import auth
+    from benchmark import JWKSStub, seed
+    from models import db
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        movies = seed(args.actors)
+
+    stub = JWKSStub()
+    issuer = 'https://' + auth.AUTH0_DOMAIN + '/'
+    tokens = [stub.mint(issuer, auth.API_AUDIENCE, 'bench|workers')]
+    env = dict(os.environ, DATABASE_URL=database_url, JWKS_URL=stub.url,
+               BENCH_DB_LATENCY_MS=str(args.db_latency_ms))
+    if args.workers is not None:
+        env['WEB_CONCURRENCY'] = str(args.workers)
+
+    report = {}
+    print('%-20s %8s %10s %9s %9s %7s' % (
+        'mode', 'ready', 'req/s', 'p50', 'p99', 'errors'))
+    for mode in args.modes.split(','):
+        if mode == 'gevent':
+            try:
+                import gevent  # noqa: F401
+            except ImportError:
+                print('%-20s skipped, gevent is not installed' % mode)
+                continue
+        ready, results = run_mode(mode, args, env, tokens, movies)
+        total = sum(r['requests'] for r in results.values())
+        seconds = sum(r['requests'] / r['throughput_rps']
+                      for r in results.values())
+        report[mode] = {'ready_s': round(ready, 2), 'routes': results}
+        print('%-20s %7.2fs %10.1f %7.2fms %7.2fms %7d' % (
+            mode, ready, total / seconds,
+            max(r['p50_ms'] for r in results.values()),
+            max(r['p99_ms'] for r in results.values()),
+            sum(r['errors'] for r in results.values())))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,306 @@
+"""Load test and benchmark for the casting API.
+
+Runs the app in-process behind a threaded HTTP server, with a local JWKS
+stub standing in for Auth0 and a synthetic catalog standing in for the
+production database, then drives every endpoint at a fixed concurrency
+and reports throughput and p50/p95/p99 latency per route.
+
+    python benchmark.py --actors 100000 --concurrency 16 --requests 2000
+
+The database defaults to a SQLite file; pass --database-url to run
+against a local PostgreSQL instead. Results are written as JSON (one file
+per commit under bench_results/ by default) and can be compared with
+--compare.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import rsa
+from jose import jwk, jwt
+from werkzeug.serving import make_server
+
+from app import create_app, encode_cursor
+from auth import auth
+from models import db, Movie, Actor, bump_version
+
+KID = 'benchmark-key'
+PERMISSIONS = [
+    'get:movies', 'post:movie', 'patch:movie', 'delete:movie',
+    'get:actors', 'post:actor', 'patch:actor', 'delete:actor',
+]
+
+
+class JWKSStub:
+    """Serves a locally generated RSA key as /.well-known/jwks.json and
+    mints tokens signed with it."""
+
+    def __init__(self):
+        self.private_key = rsa.newkeys(2048)[1].save_pkcs1().decode()
+        public = jwk.construct(self.private_key, 'RS256').public_key()
+        key = public.to_dict()
+        key.update({'kid': KID, 'use': 'sig'})
+        body = json.dumps({'keys': [key]}).encode('utf-8')
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Cache-Control', 'max-age=600')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/.well-known/jwks.json' % \
+            self.server.server_port
+
+    def mint(self, issuer, audience, subject):
+        now = int(time.time())
+        return jwt.encode({
+            'iss': issuer,
+            'sub': subject,
+            'aud': audience,
+            'iat': now,
+            'exp': now + 3600,
+            'permissions': PERMISSIONS,
+        }, self.private_key, algorithm='RS256', headers={'kid': KID})
+
+
+def seed(actors, chunk=10000):
+    '''Fills the catalog with `actors` actors spread over actors / 10
+    movies, in chunked multi-row inserts'''
+    movies = max(actors // 10, 1)
+    for start in range(0, movies, chunk):
+        db.session.execute(Movie.__table__.insert(), [
+            {'title': f'Movie {i}', 'release_date': datetime(2000, 1, 1)}
+            for i in range(start, min(start + chunk, movies))
+        ])
+    for start in range(0, actors, chunk):
+        db.session.execute(Actor.__table__.insert(), [
+            {'name': f'Actor {i}', 'age': 20 + i % 60,
+             'gender': 'MF'[i % 2], 'movie_id': i % movies + 1}
+            for i in range(start, min(start + chunk, actors))
+        ])
+    bump_version(Movie.__tablename__, Actor.__tablename__)
+    db.session.commit()
+    return movies
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    index = min(len(samples) - 1, max(0, int(round(pct / 100.0 *
+                                                   len(samples))) - 1))
+    return samples[index]
+
+
+def routes(movies, actors):
+    '''(name, method, path factory, body factory) for every endpoint.
+    Writes work on ids from the top of the catalog so reads stay stable.'''
+    deletable = iter(range(actors, actors // 2, -1))
+    lock = threading.Lock()
+
+    def next_deletable():
+        with lock:
+            return next(deletable)
+
+    def movie_id():
+        return random.randint(1, movies)
+
+    def actor_id():
+        return random.randint(1, actors // 2)
+
+    new_actor = {'name': 'Bench Actor', 'age': 30, 'gender': 'F',
+                 'movie_id': 1}
+    return [
+        ('GET /movies', 'GET', lambda: '/movies', None),
+        ('GET /movies?cursor', 'GET',
+         lambda: '/movies?cursor=%s' % encode_cursor(movie_id()), None),
+        ('GET /movies/<id>', 'GET', lambda: '/movies/%d' % movie_id(), None),
+        ('GET /actors', 'GET', lambda: '/actors', None),
+        ('GET /actors?cursor', 'GET',
+         lambda: '/actors?cursor=%s' % encode_cursor(actor_id()), None),
+        ('GET /actors/<id>', 'GET', lambda: '/actors/%d' % actor_id(), None),
+        ('GET /search', 'GET',
+         lambda: '/search?q=Actor%%20%d' % actor_id(), None),
+        ('POST /movies', 'POST', lambda: '/movies',
+         lambda: {'title': 'Bench Movie', 'release_date': '2020-01-01'}),
+        ('POST /actors', 'POST', lambda: '/actors', lambda: new_actor),
+        ('POST /actors/bulk', 'POST', lambda: '/actors/bulk',
+         lambda: [new_actor] * 100),
+        ('PATCH /movies/<id>', 'PATCH', lambda: '/movies/%d' % movie_id(),
+         lambda: {'title': 'Renamed'}),
+        ('PATCH /actors/<id>', 'PATCH', lambda: '/actors/%d' % actor_id(),
+         lambda: {'age': 31}),
+        ('DELETE /actors/<id>', 'DELETE',
+         lambda: '/actors/%d' % next_deletable(), None),
+    ]
+
+
+def run_route(base_url, tokens, method, path, body, concurrency, requests):
+    def one(i):
+        data = None
+        headers = {'Authorization': 'Bearer ' + tokens[i % len(tokens)]}
+        if body is not None:
+            data = json.dumps(body()).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        request = Request(base_url + path(), data=data, headers=headers,
+                          method=method)
+        start = time.perf_counter()
+        try:
+            with urlopen(request) as response:
+                response.read()
+                ok = response.status < 400
+        except HTTPError as error:
+            error.read()
+            ok = False
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency * 1000 for latency, _ in results)
+    return {
+        'requests': requests,
+        'errors': sum(1 for _, ok in results if not ok),
+        'throughput_rps': round(requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return 'unknown'
+
+
+def compare(previous, current):
+    print('\n%-22s %12s %12s %10s' % ('route', 'p99 before', 'p99 after',
+                                       'rps delta'))
+    for name, result in current['routes'].items():
+        before = previous['routes'].get(name)
+        if before is None:
+            continue
+        delta = (result['throughput_rps'] / before['throughput_rps'] - 1) \
+            * 100 if before['throughput_rps'] else 0
+        print('%-22s %10.2fms %10.2fms %+9.1f%%' % (
+            name, before['p99_ms'], result['p99_ms'], delta))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--actors', type=int, default=10000,
+                        help='catalog size, 10^3 to 10^7 (movies = /10)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per route')
+    parser.add_argument('--tokens', type=int, default=1,
+                        help='distinct bearer tokens (simulated clients)')
+    parser.add_argument('--routes', default='',
+                        help='comma separated route name filter')
+    parser.add_argument('--database-url', default=None,
+                        help='defaults to a temporary SQLite file')
+    parser.add_argument('--reset', action='store_true',
+                        help='drop and reseed the tables of --database-url')
+    parser.add_argument('--output', default=None,
+                        help='defaults to bench_results/<commit>.json')
+    parser.add_argument('--compare', default=None,
+                        help='previous results file to compare against')
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix='casting-bench-')
+    database_url = args.database_url or \
+        'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+    os.environ['DATABASE_URL'] = database_url
+
+    stub = JWKSStub()
+    auth.jwks_cache.url = stub.url
+    auth.jwks_cache.clear()
+    issuer = 'https://' + auth.AUTH0_DOMAIN + '/'
+    tokens = [stub.mint(issuer, auth.API_AUDIENCE, 'bench|%d' % i)
+              for i in range(args.tokens)]
+
+    app = create_app()
+    with app.app_context():
+        if args.reset:
+            db.drop_all()
+        db.create_all()
+        if Actor.query.limit(1).count():
+            sys.exit('%s already holds a catalog, pass --reset to replace '
+                     'it' % database_url)
+        started = time.perf_counter()
+        movies = seed(args.actors)
+        print('seeded %d movies / %d actors in %.1fs' % (
+            movies, args.actors, time.perf_counter() - started))
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+
+    wanted = [name.strip() for name in args.routes.split(',') if name]
+    results = {}
+    for name, method, path, body in routes(movies, args.actors):
+        if wanted and not any(w in name for w in wanted):
+            continue
+        results[name] = run_route(base_url, tokens, method, path, body,
+                                  args.concurrency, args.requests)
+        r = results[name]
+        print('%-22s %8.1f req/s  p50 %7.2fms  p95 %7.2fms  p99 %7.2fms'
+              '  errors %d' % (name, r['throughput_rps'], r['p50_ms'],
+                               r['p95_ms'], r['p99_ms'], r['errors']))
+    server.shutdown()
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'database': database_url.split(':', 1)[0],
+        'actors': args.actors,
+        'movies': movies,
+        'concurrency': args.concurrency,
+        'requests_per_route': args.requests,
+        'tokens': args.tokens,
+        'routes': results,
+    }
+    output = args.output or os.path.join('bench_results',
+                                         report['commit'] + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('results written to %s' % output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class LRUBackend:
+    """In-process LRU bounded by the total size of the cached bodies."""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.bytes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, body, tags):
+        size = len(key) + len(body)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self._discard(key)
+            self.entries[key] = (body, tags)
+            self.bytes += size
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while self.bytes > self.max_bytes:
+                self._discard(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, tag):
+        with self.lock:
+            for key in self.tags.pop(tag, ()):
+                self._discard(key)
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        body, tags = entry
+        self.bytes -= len(key) + len(body)
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': 'memory',
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+            }
+
+
+class SharedStoreBackend:
+    """Backend on a shared key-value store with a Redis-like client
+    (get, set with `ex`, delete, sadd, smembers, expire), so every worker
+    sees the same entries. A set per tag records which keys to drop on a
+    write; it expires with the newest entry added to it."""
+
+    def __init__(self, client, ttl=300, prefix='casting:cache:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, body, tags):
+        key = self.prefix + key
+        self.client.set(key, body, ex=self.ttl)
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            self.client.sadd(tag_key, key)
+            self.client.expire(tag_key, self.ttl)
+
+    def invalidate(self, tag):
+        tag_key = self.prefix + 'tag:' + tag
+        keys = list(self.client.smembers(tag_key))
+        self.client.delete(tag_key, *keys)
+
+    def stats(self):
+        return {
+            'backend': 'shared',
+            'ttl': self.ttl,
+        }
+
+
+class ResponseCache:
+    """Read-through cache of serialized response bodies.
+
+    Entries are tagged with the tables they were read from, and a write to
+    a table drops every entry carrying its tag.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        if self.backend is None:
+            return None
+        body = self.backend.get(key)
+        with self.lock:
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return body
+
+    def set(self, key, body, tags):
+        if self.backend is not None:
+            self.backend.set(key, body, tags)
+
+    def invalidate(self, tags):
+        if self.backend is None:
+            return
+        for tag in tags:
+            self.backend.invalidate(tag)
+        with self.lock:
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            stats = {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'invalidations': self.invalidations,
+            }
+        if self.backend is not None:
+            stats.update(self.backend.stats())
+        return stats
+
+
+def backend_from_env():
+    '''RESPONSE_CACHE=memory (default), redis or off'''
+    kind = os.getenv('RESPONSE_CACHE', 'memory')
+    if kind == 'off':
+        return None
+    if kind == 'redis':
+        import redis
+        client = redis.Redis.from_url(os.environ['RESPONSE_CACHE_URL'])
+        return SharedStoreBackend(
+            client, ttl=int(os.getenv('RESPONSE_CACHE_TTL', 300))
+        )
+    return LRUBackend(
+        max_bytes=int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+    )
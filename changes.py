@@ -0,0 +1,330 @@
+"""GET /changes: a Server-Sent Events feed of movie and actor writes.
+
+Every committed transaction that writes movies or actors produces one
+event per table and operation, stored in change_events (see models.py):
+
+    id: 42
+    event: change
+    data: {"id": 42, "table": "actors", "op": "update", "ids": [3, 7]}
+
+Clients resume after a dropped connection with the standard Last-Event-ID
+header (or ?last_event_id=); the missed events are replayed from the
+table before live ones follow. When more than CHANGES_REPLAY_LIMIT events
+were missed, the stream ends after that many, and the client's next
+reconnect picks up the rest.
+
+Within a process events reach subscribers through an in-memory Broker.
+On PostgreSQL the commit also sends NOTIFY casting_changes, and each
+process runs one LISTEN thread that loads the notified events and hands
+them to its broker, so a write in one gunicorn worker reaches clients of
+every worker. Elsewhere (SQLite in tests and development) events are
+handed to the broker directly after commit.
+
+An open stream holds its server thread the whole time, so each process
+takes at most CHANGES_MAX_SUBSCRIBERS of them and answers the next with
+503 and Retry-After.
+"""
+import os
+import queue
+import select
+import threading
+import time
+
+from flask import Response, abort, request, stream_with_context
+
+import admission
+import metrics
+from auth.auth import requires_auth
+from fastjson import dumps
+from models import db, ChangeEvent, CHANGES_CHANNEL, on_change_events
+
+
+CHANGES_HEARTBEAT = float(os.getenv('CHANGES_HEARTBEAT', 15))
+CHANGES_MAX_DURATION = float(os.getenv('CHANGES_MAX_DURATION', 300))
+CHANGES_QUEUE_SIZE = int(os.getenv('CHANGES_QUEUE_SIZE', 1000))
+CHANGES_REPLAY_LIMIT = int(os.getenv('CHANGES_REPLAY_LIMIT', 10000))
+# Every open stream holds a server thread for up to CHANGES_MAX_DURATION,
+# outside admission control. By default streams may take half of the
+# process's threads, or the quarter that admission control leaves over.
+CHANGES_MAX_SUBSCRIBERS = int(os.getenv(
+    'CHANGES_MAX_SUBSCRIBERS',
+    max(2, admission.ADMISSION_THREADS //
+        (4 if admission.ADMISSION_CONTROL else 2))))
+RETRY_MS = 2000
+
+OVERFLOW = object()
+
+
+class Broker:
+    """In-process fan-out of change events to subscriber queues."""
+
+    def __init__(self, maxsize=CHANGES_QUEUE_SIZE,
+                 max_subscribers=CHANGES_MAX_SUBSCRIBERS):
+        self.maxsize = maxsize
+        self.max_subscribers = max_subscribers
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        '''A new subscriber queue, or None when there are already
+        `max_subscribers`'''
+        subscriber = queue.Queue(self.maxsize)
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'subscribers': len(self.subscribers),
+                'max_subscribers': self.max_subscribers,
+            }
+
+    def publish(self, events):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                for event in events:
+                    subscriber.put_nowait(event)
+            except queue.Full:
+                # A client too slow to keep up is cut off; it reconnects
+                # with Last-Event-ID and catches up from the table.
+                self.cut_off(subscriber)
+
+    def cut_off(self, subscriber=None):
+        '''Ends the stream of `subscriber`, or of every subscriber'''
+        if subscriber is None:
+            with self.lock:
+                subscribers = list(self.subscribers)
+            for subscriber in subscribers:
+                self.cut_off(subscriber)
+            return
+        self.unsubscribe(subscriber)
+        with subscriber.mutex:
+            subscriber.queue.clear()
+        subscriber.put_nowait(OVERFLOW)
+
+
+class PostgresListener:
+    """LISTENs on casting_changes and publishes the notified events to
+    `broker`, reconnecting with backoff if the connection drops.
+
+    NOTIFYs sent while the connection is down are lost, so after every
+    LISTEN the events after the last one published (`last_id`) are loaded
+    from the table first."""
+
+    def __init__(self, engine, broker, last_id=0):
+        self.engine = engine
+        self.broker = broker
+        self.last_id = last_id
+        self.thread = None
+        self.lock = threading.Lock()
+        # Set while LISTEN is in effect; until then nothing is received.
+        self.listening = threading.Event()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.run, name='changes-listener', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        delay = 1
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+            else:
+                delay = 1
+
+    def listen(self):
+        connection = self.engine.raw_connection()
+        # A dedicated connection, closed rather than returned to the pool.
+        connection.detach()
+        try:
+            dbapi = connection.connection
+            dbapi.autocommit = True
+            with dbapi.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANGES_CHANNEL}')
+            self.catch_up()
+            self.listening.set()
+            while True:
+                if select.select([dbapi], [], [], CHANGES_HEARTBEAT)[0]:
+                    dbapi.poll()
+                    ids = []
+                    while dbapi.notifies:
+                        notify = dbapi.notifies.pop(0)
+                        ids.extend(int(i) for i in notify.payload.split(','))
+                    if ids:
+                        self.publish(self.load(ids))
+        finally:
+            self.listening.clear()
+            connection.close()
+
+    def catch_up(self):
+        '''Publishes the events committed since `last_id`'''
+        table = ChangeEvent.__table__
+        with self.engine.connect() as conn:
+            rows = conn.execute(table.select()
+                                .where(table.c.id > self.last_id)
+                                .order_by(table.c.id)
+                                .limit(self.broker.maxsize)).fetchall()
+        events = [ChangeEvent(**row._mapping).format() for row in rows]
+        if len(events) == self.broker.maxsize:
+            # More than any subscriber queue holds: end every stream, so
+            # that clients replay the rest from the table.
+            self.broker.cut_off()
+        self.publish(events)
+
+    def publish(self, events):
+        # Catching up may load events that are also notified.
+        events = [event for event in events if event['id'] > self.last_id]
+        if events:
+            self.last_id = events[-1]['id']
+            self.broker.publish(events)
+
+    def load(self, ids):
+        table = ChangeEvent.__table__
+        with self.engine.connect() as conn:
+            rows = conn.execute(table.select().where(table.c.id.in_(ids))
+                                .order_by(table.c.id))
+            return [ChangeEvent(**row._mapping).format() for row in rows]
+
+
+broker = Broker()
+# Started by the first GET /changes on PostgreSQL; once it is listening,
+# events reach the broker through LISTEN rather than straight from
+# commits.
+listener = None
+
+
+def publish_committed(events):
+    # Until LISTEN is in effect (and while the listener reconnects) this
+    # process's own commits would otherwise reach nobody. A commit that
+    # arrives both ways is dropped by the stream as already sent.
+    if listener is None or not listener.listening.is_set():
+        broker.publish(events)
+
+
+on_change_events(publish_committed)
+
+
+def format_event(event):
+    return (f"id: {event['id']}\nevent: change\n"
+            f"data: {dumps(event).decode('utf-8')}\n\n")
+
+
+def last_event_id(request):
+    value = request.headers.get('Last-Event-ID',
+                                request.args.get('last_event_id', None))
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def stream_changes(tables, since):
+    '''SSE body: events after `since` replayed from change_events, then
+    live events, for CHANGES_MAX_DURATION seconds'''
+    subscriber = broker.subscribe()
+    if subscriber is None:
+        return admission.reject(503, 'too many subscribers',
+                                admission.ADMISSION_RETRY_AFTER)
+
+    def generate():
+        last = since
+        try:
+            yield f'retry: {RETRY_MS}\n\n'
+            if since is not None:
+                replay = ChangeEvent.query \
+                    .filter(ChangeEvent.id > since) \
+                    .filter(ChangeEvent.table_name.in_(tables)) \
+                    .order_by(ChangeEvent.id) \
+                    .limit(CHANGES_REPLAY_LIMIT)
+                replayed = [event.format() for event in replay]
+                for event in replayed:
+                    last = event['id']
+                    yield format_event(event)
+                if len(replayed) == CHANGES_REPLAY_LIMIT:
+                    # There may be more to replay. Live events would skip
+                    # over them, so end here; the client reconnects with
+                    # the last id and gets the next page.
+                    return
+            # Nothing else reads the database; give the connection back.
+            db.session.remove()
+
+            deadline = time.monotonic() + CHANGES_MAX_DURATION
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    event = subscriber.get(
+                        timeout=min(CHANGES_HEARTBEAT, remaining))
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if event is OVERFLOW:
+                    return
+                if event['table'] not in tables or \
+                        (last is not None and event['id'] <= last):
+                    continue
+                last = event['id']
+                yield format_event(event)
+        finally:
+            broker.unsubscribe(subscriber)
+
+    response = Response(stream_with_context(generate()),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    # Also for a response closed before its body was started.
+    response.call_on_close(lambda: broker.unsubscribe(subscriber))
+    return response
+
+
+def start_listener():
+    '''On PostgreSQL, makes sure this process is LISTENing'''
+    global listener
+    if listener is None and db.engine.dialect.name == 'postgresql':
+        # Commits before this point were published directly.
+        last_id = db.session.query(db.func.max(ChangeEvent.id)).scalar()
+        listener = PostgresListener(db.engine, broker, last_id or 0)
+    if listener is not None:
+        listener.start()
+
+
+def init_app(app):
+    metrics.register_stats('changes', broker.stats)
+
+    @app.route('/changes')
+    @requires_auth('get:movies')
+    def changes(payload):
+        tables = {'movies'}
+        if 'get:actors' in payload.get('permissions', []):
+            tables.add('actors')
+        wanted = request.args.get('tables', None)
+        if wanted is not None:
+            wanted = {table.strip() for table in wanted.split(',')}
+            if not wanted <= {'movies', 'actors'}:
+                abort(400)
+            tables &= wanted
+            if not tables:
+                # Only actors, without get:actors: nothing could be sent.
+                abort(403)
+
+        since = last_event_id(request)
+        start_listener()
+        return stream_changes(tables, since)
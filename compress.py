@@ -0,0 +1,151 @@
+"""Response compression negotiated with Accept-Encoding.
+
+gzip is always available; zstd and brotli are offered when the
+`zstandard` and `brotli` packages are installed. Buffered bodies below
+COMPRESS_MIN_SIZE bytes are sent as they are, since compressing them
+costs more time than it saves on the wire. Streamed bodies are
+compressed incrementally and flushed every COMPRESS_FLUSH_SIZE input
+bytes, so clients keep receiving data as it is produced.
+
+    COMPRESS_MIN_SIZE=1024  GZIP_LEVEL=6  BROTLI_LEVEL=4  ZSTD_LEVEL=3
+"""
+import os
+import zlib
+
+from flask import request
+
+from metrics import timed
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_FLUSH_SIZE = int(os.getenv('COMPRESS_FLUSH_SIZE', 64 * 1024))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', 6))
+BROTLI_LEVEL = int(os.getenv('BROTLI_LEVEL', 4))
+ZSTD_LEVEL = int(os.getenv('ZSTD_LEVEL', 3))
+
+
+class GzipEncoder:
+    def __init__(self):
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliEncoder:
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=BROTLI_LEVEL)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class ZstdEncoder:
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(
+            level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+# In order of preference when the client accepts several equally.
+ENCODERS = {}
+if zstandard is not None:
+    ENCODERS['zstd'] = ZstdEncoder
+if brotli is not None:
+    ENCODERS['br'] = BrotliEncoder
+ENCODERS['gzip'] = GzipEncoder
+
+
+def negotiate(accept_encodings):
+    '''The content coding to use for a client sending `accept_encodings`,
+    or None to send the body as it is'''
+    return accept_encodings.best_match(list(ENCODERS))
+
+
+def compress_stream(chunks, encoder):
+    pending = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = encoder.compress(chunk)
+            pending += len(chunk)
+            if pending >= COMPRESS_FLUSH_SIZE:
+                data += encoder.flush()
+                pending = 0
+            if data:
+                yield data
+        yield encoder.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response):
+    '''Compresses `response` in place if the client accepts a coding we
+    offer and the body is worth compressing'''
+    if response.status_code < 200 or response.status_code in (204, 304) \
+            or response.direct_passthrough \
+            or 'Content-Encoding' in response.headers \
+            or response.mimetype == 'text/event-stream' \
+            or request.method == 'HEAD':
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response,
+                                            ENCODERS[encoding]())
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_SIZE:
+            return response
+        with timed('compress'):
+            encoder = ENCODERS[encoding]()
+            response.set_data(encoder.compress(body) + encoder.finish())
+
+    response.headers['Content-Encoding'] = encoding
+    # The compressed bytes differ from the identity ones, so the ETag can
+    # only claim weak equivalence; If-None-Match still matches it.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    app.after_request(compress_response)
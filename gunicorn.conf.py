@@ -0,0 +1,111 @@
+"""gunicorn settings for the casting API, read from the environment.
+
+    gunicorn wsgi:app
+
+(gunicorn picks up ./gunicorn.conf.py by itself.) The API spends most of
+a request waiting on Auth0 and PostgreSQL, so the default is gthread:
+GUNICORN_THREADS threads per worker and one worker per core, so that a
+request waiting on I/O does not hold a whole process. Set
+GUNICORN_WORKER_CLASS=gevent (with the gevent and psycogreen packages
+installed) for one greenlet per request instead, or sync for the old
+behaviour of one request per process.
+
+    GUNICORN_WORKER_CLASS  gthread | gevent | sync     (gthread)
+    WEB_CONCURRENCY        worker processes    (cores; 2 * cores + 1 sync)
+    GUNICORN_THREADS       threads per gthread worker               (8)
+    GUNICORN_WORKER_CONNECTIONS  greenlets per gevent worker     (1000)
+    GUNICORN_PRELOAD       build the app once in the master  (1; 0 gevent)
+    GUNICORN_MAX_REQUESTS  recycle a worker after this many        (1000)
+    GUNICORN_TIMEOUT, GUNICORN_GRACEFUL_TIMEOUT, GUNICORN_KEEPALIVE
+
+With preloading, the master imports wsgi.py, which builds and warms up
+the app, and every worker is forked with the signing keys, mappers and
+compiled queries already in memory. Database connections must not be
+shared across processes, so the master closes its pool before each fork
+and every worker opens its own. Nothing else starts a thread before a
+request needs it (the GET /changes listener, the POST /batch pool), so
+forking the preloaded master is safe.
+
+Each worker keeps its own connection pool: with PostgreSQL, workers *
+(DB_POOL_SIZE + DB_MAX_OVERFLOW) must stay below max_connections, and
+DB_POOL_SIZE should be at least GUNICORN_THREADS.
+"""
+import multiprocessing
+import os
+import sys
+
+
+cores = multiprocessing.cpu_count()
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+if worker_class == 'sync':
+    default_workers = 2 * cores + 1
+else:
+    default_workers = cores
+workers = int(os.getenv('WEB_CONCURRENCY', default_workers))
+# More than one thread would turn sync workers into gthread ones.
+threads = int(os.getenv('GUNICORN_THREADS',
+                        8)) if worker_class == 'gthread' else 1
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+# Requests one worker serves at once, which admission.py sizes its
+# default limits from; the workers inherit it.
+admission_threads = int(os.environ.setdefault('ADMISSION_THREADS', str(
+    worker_connections if worker_class == 'gevent' else threads)))
+
+# gevent patches the standard library when a worker starts, after a
+# preloaded app would already have created its locks and sockets.
+preload_app = os.getenv('GUNICORN_PRELOAD',
+                        '0' if worker_class == 'gevent' else '1') == '1'
+
+# Recycling workers bounds the growth of per-process caches and any leak;
+# the jitter keeps them from all restarting at once.
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER',
+                                    max_requests // 10))
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+
+def loaded_engines():
+    '''Engines of the app wsgi.py built in this process, if it was
+    imported here'''
+    wsgi = sys.modules.get('wsgi')
+    if wsgi is None:
+        return []
+    from warmup import app_engines
+    return app_engines(wsgi.app)
+
+
+def pre_fork(server, worker):
+    # Runs in the master. Connections opened while preloading would be
+    # shared with the child; close them so each worker starts clean.
+    for engine in loaded_engines():
+        engine.dispose()
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent' and \
+            os.getenv('DATABASE_URL', 'postgresql').startswith('postgres'):
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            server.log.warning('psycogreen is not installed; PostgreSQL '
+                               'queries will block the gevent worker')
+        else:
+            patch_psycopg()
+
+
+def post_worker_init(worker):
+    # A worker forked from a preloaded master inherited the warm caches
+    # but no connections; open its own before it accepts requests.
+    from warmup import WARMUP, open_connections
+    if not preload_app or not WARMUP:
+        return
+    for engine in loaded_engines():
+        try:
+            open_connections(engine)
+        except Exception:
+            worker.log.warning('could not open connections to %r',
+                               engine.url, exc_info=True)
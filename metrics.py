@@ -0,0 +1,211 @@
+"""Per-request phase timing and Prometheus metrics.
+
+Every request accumulates the time spent in each phase (auth, jwks, jwt,
+db, serialize) on flask.g. After the request the phases are written out
+as a Server-Timing header and folded into histograms that GET /metrics
+exposes in the Prometheus text format. Recording a phase is a
+perf_counter call and a dict update, cheap enough to leave on.
+
+The registry is per process; under gunicorn each worker reports its own
+series, so scrape workers individually or aggregate by instance.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.labels, key)}'
+                             f' {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0, 0.0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} histogram']
+        names = self.labels + ('le',)
+        with self.lock:
+            for key, (counts, count, total) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    lines.append(f'{self.name}_bucket'
+                                 f'{format_labels(names, key + (bound,))}'
+                                 f' {cumulative}')
+                lines.append(f'{self.name}_bucket'
+                             f'{format_labels(names, key + ("+Inf",))}'
+                             f' {count}')
+                labels = format_labels(self.labels, key)
+                lines.append(f'{self.name}_count{labels} {count}')
+                lines.append(f'{self.name}_sum{labels} {total}')
+        return lines
+
+
+request_count = Counter(
+    'http_requests_total', 'HTTP requests served.',
+    ('route', 'method', 'status', 'permission'))
+request_latency = Histogram(
+    'http_request_duration_seconds', 'Time to produce a response.',
+    ('route', 'method', 'status', 'permission'))
+phase_latency = Histogram(
+    'http_request_phase_seconds', 'Time spent in each request phase.',
+    ('route', 'phase'))
+
+# Everything GET /metrics exposes besides the stats gauges below.
+collectors = [request_count, request_latency, phase_latency]
+
+# Extra gauges, name -> callable returning a dict of numbers.
+stats_providers = {}
+
+
+def register(metric):
+    '''Adds a Counter or Histogram defined elsewhere to GET /metrics'''
+    collectors.append(metric)
+    return metric
+
+
+def register_stats(name, provider):
+    stats_providers[name] = provider
+
+
+def record(phase, seconds):
+    '''Adds `seconds` to `phase` of the current request, if any'''
+    if has_request_context():
+        timings = g.setdefault('timings', {})
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - start)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    if context is not None:
+        context._query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context,
+                     executemany):
+    started = getattr(context, '_query_started', None)
+    if started is not None:
+        record('db', time.perf_counter() - started)
+
+
+def expose():
+    lines = []
+    for metric in collectors:
+        lines.extend(metric.expose())
+    for name, provider in sorted(stats_providers.items()):
+        for key, value in sorted(provider().items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            lines.append(f'# TYPE casting_{name}_{key} gauge')
+            lines.append(f'casting_{name}_{key} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    '''Installs the timing hooks and the /metrics endpoint on `app`'''
+    # auth.auth imports this module for timed().
+    from auth.auth import requires_auth
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def finish_request_timer(response):
+        started = g.get('request_started')
+        if started is None:
+            return response
+        total = time.perf_counter() - started
+        timings = g.get('timings', {})
+
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = {
+            'route': route,
+            'method': request.method,
+            'status': str(response.status_code),
+            'permission': g.get('permission', ''),
+        }
+        request_count.inc(**labels)
+        request_latency.observe(total, **labels)
+        for phase, seconds in timings.items():
+            phase_latency.observe(seconds, route=route, phase=phase)
+
+        entries = [f'{phase};dur={seconds * 1000:.2f}'
+                   for phase, seconds in timings.items()]
+        entries.append(f'total;dur={total * 1000:.2f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+        return response
+
+    @app.route('/metrics')
+    @requires_auth('get:internal')
+    def metrics(payload):
+        return Response(expose(), mimetype='text/plain; version=0.0.4')
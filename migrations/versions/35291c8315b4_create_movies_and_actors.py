@@ -0,0 +1,41 @@
+"""create movies and actors
+
+Revision ID: 35291c8315b4
+Revises: 
+Create Date: 2021-12-27 10:12:45.118293
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '35291c8315b4'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'movies',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.String(), nullable=True),
+        sa.Column('release_date', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'actors',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(), nullable=True),
+        sa.Column('age', sa.Integer(), nullable=True),
+        sa.Column('gender', sa.String(), nullable=True),
+        sa.Column('movie_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('actors')
+    op.drop_table('movies')
@@ -0,0 +1,33 @@
+"""add table_versions
+
+Revision ID: 7f1b2c9d4e10
+Revises: 35291c8315b4
+Create Date: 2026-10-18 09:05:12.402811
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7f1b2c9d4e10'
+down_revision = '35291c8315b4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('table_name', sa.String(length=63), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('table_name')
+    )
+    op.bulk_insert(table_versions, [
+        {'table_name': 'movies', 'version': 1},
+        {'table_name': 'actors', 'version': 1},
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
@@ -0,0 +1,33 @@
+"""add change_events
+
+Revision ID: 9b3d61f0a7c2
+Revises: e2a7d5b0c8f1
+Create Date: 2026-10-18 15:42:37.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b3d61f0a7c2'
+down_revision = 'e2a7d5b0c8f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'change_events',
+        sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'),
+                  nullable=False),
+        sa.Column('table_name', sa.String(length=63), nullable=False),
+        sa.Column('op', sa.String(length=16), nullable=False),
+        sa.Column('row_ids', sa.Text(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('change_events')
@@ -0,0 +1,48 @@
+"""add indexes for the API access paths
+
+Revision ID: c4e8a2d6f913
+Revises: 7f1b2c9d4e10
+Create Date: 2026-10-18 09:41:37.550264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a2d6f913'
+down_revision = '7f1b2c9d4e10'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    # Loading a movie's actors and nulling them out when it is deleted.
+    ('ix_actors_movie_id', 'actors', ['movie_id']),
+    # Date-ordered movie listings.
+    ('ix_movies_release_date', 'movies', ['release_date']),
+    # Lookups by name and title.
+    ('ix_movies_title', 'movies', ['title']),
+    ('ix_actors_name', 'actors', ['name']),
+]
+
+
+def upgrade():
+    # Build the indexes without blocking writes on large PostgreSQL tables;
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    postgresql = op.get_bind().dialect.name == 'postgresql'
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            if postgresql:
+                # A cancelled build leaves an INVALID index behind; drop
+                # it so the upgrade can simply be run again.
+                op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+            op.create_index(name, table, columns, unique=False,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
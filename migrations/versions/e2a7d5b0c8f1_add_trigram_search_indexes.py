@@ -0,0 +1,51 @@
+"""add trigram indexes for /search
+
+Revision ID: e2a7d5b0c8f1
+Revises: c4e8a2d6f913
+Create Date: 2026-10-18 11:02:54.917036
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a7d5b0c8f1'
+down_revision = 'c4e8a2d6f913'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_movies_title_trgm', 'movies', 'title'),
+    ('ix_actors_name_trgm', 'actors', 'name'),
+]
+
+
+def upgrade():
+    # Trigram indexes serve both the fuzzy (%) and the ILIKE prefix
+    # matches of /search. They only exist on PostgreSQL; elsewhere search
+    # falls back to LIKE.
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    with op.get_context().autocommit_block():
+        for name, table, column in INDEXES:
+            # See c4e8a2d6f913: clear out an INVALID index left by a
+            # cancelled build before building it again.
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+            op.create_index(name, table, [column], unique=False,
+                            postgresql_using='gin',
+                            postgresql_ops={column: 'gin_trgm_ops'},
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    with op.get_context().autocommit_block():
+        for name, table, column in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
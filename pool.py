@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+
+class PoolStats:
+    """Counters describing how long requests wait for a connection."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds, timed_out=False):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': self.wait_total,
+                'wait_seconds_avg':
+                    self.wait_total / self.checkouts if self.checkouts else 0.0,
+                'wait_seconds_max': self.wait_max,
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records the time spent waiting for a connection.
+
+    Each engine's pool keeps its own PoolStats, so the primary and every
+    replica are reported apart. The stats are handed on when the pool is
+    recreated (Engine.dispose, or after a disconnect).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self.stats.record_wait(time.perf_counter() - start, timed_out)
+
+
+def engine_options(uri):
+    '''SQLAlchemy engine options for `uri`, tuned from the environment:
+
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (seconds to wait for a
+    connection), DB_POOL_RECYCLE (seconds), DB_POOL_PRE_PING (1/0) and
+    DB_STATEMENT_TIMEOUT (milliseconds, PostgreSQL only).
+    '''
+    url = make_url(uri)
+    if url.get_backend_name() == 'sqlite':
+        # SQLite uses its own single-connection pools.
+        return {}
+
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') == '1',
+    }
+
+    statement_timeout = int(os.getenv('DB_STATEMENT_TIMEOUT', 15000))
+    if url.get_backend_name() == 'postgresql' and statement_timeout:
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={statement_timeout}'
+        }
+
+    return options
+
+
+def pool_status(engine):
+    '''Snapshot of the engine's pool for the /internal/pool view'''
+    pool = engine.pool
+    status = {'class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+            'max_overflow': pool._max_overflow,
+        })
+    if isinstance(pool, InstrumentedQueuePool):
+        status.update(pool.stats.as_dict())
+    return status
@@ -0,0 +1,188 @@
+"""Read-replica routing.
+
+With DATABASE_REPLICA_URLS set (comma separated), GET and HEAD requests
+read from the replicas in round-robin order and everything else uses the
+primary DATABASE_URL. A client that has just written reads from the
+primary for READ_YOUR_WRITES_WINDOW seconds so it sees its own changes
+despite replication lag; clients are recognised by their Authorization
+header or by a cookie set on the write response.
+
+Each replica is pinged before its first use. One that fails to connect
+is taken out of rotation and pinged again after REPLICA_RETRY_INTERVAL
+seconds; with no healthy replica left reads fall back to the primary.
+"""
+import hashlib
+import itertools
+import os
+import threading
+import time
+
+from flask import request
+from sqlalchemy import create_engine, event, text
+from flask_sqlalchemy import SignallingSession
+
+from pool import engine_options, pool_status
+
+
+REPLICA_URLS = os.getenv('DATABASE_REPLICA_URLS', '')
+READ_YOUR_WRITES_WINDOW = float(os.getenv('READ_YOUR_WRITES_WINDOW', 5))
+REPLICA_RETRY_INTERVAL = float(os.getenv('REPLICA_RETRY_INTERVAL', 30))
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+STICKY_COOKIE = 'read_primary_until'
+# Set in a request's WSGI environ to keep its reads on the primary, as
+# POST /batch does for sub-requests that follow its writes.
+READ_PRIMARY_ENVIRON_KEY = 'casting.read_primary'
+# Set by requests whose method does not tell whether they wrote (POST
+# /batch) to whether the client should now read from the primary.
+WROTE_ENVIRON_KEY = 'casting.wrote'
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from `info['replica']` when a request set one.
+    Flushes always go to the primary."""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get('replica')
+        if replica is not None and not self._flushing:
+            return replica
+        return super().get_bind(mapper, clause)
+
+
+class ReplicaSet:
+    """Round-robin over replica engines, skipping those that are down."""
+
+    def __init__(self, engines, retry_interval=REPLICA_RETRY_INTERVAL):
+        self.engines = engines
+        self.retry_interval = retry_interval
+        # Replicas listed here are pinged before they are used; this
+        # includes every replica until its first successful check.
+        self.down_until = dict.fromkeys(engines, 0.0)
+        self.lock = threading.Lock()
+        self.cycle = itertools.cycle(engines)
+        for engine in engines:
+            event.listen(engine, 'handle_error', self.on_error)
+
+    def on_error(self, context):
+        if context.is_disconnect or context.connection is None:
+            self.mark_down(context.engine)
+
+    def mark_down(self, engine):
+        with self.lock:
+            self.down_until[engine] = time.monotonic() + self.retry_interval
+
+    def ping(self, engine):
+        try:
+            with engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+        except Exception:
+            self.mark_down(engine)
+            return False
+        with self.lock:
+            self.down_until.pop(engine, None)
+        return True
+
+    def choose(self):
+        '''The next healthy replica, or None to use the primary'''
+        for _ in range(len(self.engines)):
+            with self.lock:
+                engine = next(self.cycle)
+                until = self.down_until.get(engine)
+            if until is None:
+                return engine
+            if until <= time.monotonic() and self.ping(engine):
+                return engine
+        return None
+
+    def status(self):
+        with self.lock:
+            healthy = [engine not in self.down_until
+                       for engine in self.engines]
+        return [{
+            'url': repr(engine.url),
+            'healthy': up,
+            'pool': pool_status(engine),
+        } for engine, up in zip(self.engines, healthy)]
+
+
+class RecentWriters:
+    """Clients (by hashed Authorization header) that wrote recently."""
+
+    def __init__(self, window=READ_YOUR_WRITES_WINDOW):
+        self.window = window
+        self.until = {}
+        self.lock = threading.Lock()
+
+    def key(self, authorization):
+        return hashlib.sha256(authorization.encode('utf-8')).digest()
+
+    def add(self, authorization):
+        now = time.monotonic()
+        with self.lock:
+            if len(self.until) > 10000:
+                self.until = {key: until for key, until in self.until.items()
+                              if until > now}
+            self.until[self.key(authorization)] = now + self.window
+
+    def __contains__(self, authorization):
+        with self.lock:
+            until = self.until.get(self.key(authorization), 0)
+        return until > time.monotonic()
+
+
+def replica_urls():
+    return [url.strip() for url in REPLICA_URLS.split(',') if url.strip()]
+
+
+def sticky(recent_writers):
+    '''Whether this request must read from the primary to see the
+    client's own recent writes'''
+    if request.environ.get(READ_PRIMARY_ENVIRON_KEY):
+        return True
+    authorization = request.headers.get('Authorization')
+    if authorization and authorization in recent_writers:
+        return True
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def init_app(app, db, urls=None):
+    '''Routes the app's safe requests to the replicas in `urls` (by
+    default DATABASE_REPLICA_URLS). Does nothing when there are none.'''
+    urls = replica_urls() if urls is None else urls
+    if not urls:
+        return None
+
+    engines = []
+    for url in urls:
+        if url.startswith('postgres://'):
+            url = url.replace('postgres://', 'postgresql://', 1)
+        engines.append(create_engine(url, **engine_options(url)))
+    replicas = ReplicaSet(engines)
+    recent_writers = RecentWriters()
+    app.extensions['replicas'] = replicas
+
+    @app.before_request
+    def route_reads():
+        session = db.session()
+        session.info.pop('replica', None)
+        if request.method in SAFE_METHODS and not sticky(recent_writers):
+            engine = replicas.choose()
+            if engine is not None:
+                session.info['replica'] = engine
+
+    @app.after_request
+    def remember_writers(response):
+        wrote = request.environ.get(WROTE_ENVIRON_KEY,
+                                    request.method not in SAFE_METHODS)
+        if wrote and response.status_code < 400:
+            authorization = request.headers.get('Authorization')
+            if authorization:
+                recent_writers.add(authorization)
+            response.set_cookie(
+                STICKY_COOKIE, str(time.time() + recent_writers.window),
+                max_age=int(recent_writers.window) or 1, httponly=True)
+        return response
+
+    return replicas
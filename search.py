@@ -0,0 +1,60 @@
+from sqlalchemy import case, func, literal
+
+from models import db, Movie, Actor
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_query(model, column, q, limit, dialect):
+    '''Ranked prefix and fuzzy matches of `q` against `column`.
+
+    On PostgreSQL candidates come from the pg_trgm GIN index on the column
+    (trigram similarity or a case-insensitive prefix) and are ranked by
+    similarity, with prefix matches first. Other databases fall back to
+    LIKE, ranking exact, then prefix, then substring matches.
+    '''
+    if dialect == 'postgresql':
+        is_prefix = column.ilike(escape_like(q) + '%', escape='\\')
+        score = func.similarity(column, q) + \
+            case((is_prefix, 1.0), else_=0.0)
+        condition = column.op('%')(q) | is_prefix
+    else:
+        lowered = func.lower(column)
+        needle = q.lower()
+        score = case(
+            (lowered == needle, 2.0),
+            (lowered.startswith(needle, autoescape=True), 1.0),
+            else_=literal(0.5)
+        )
+        condition = lowered.contains(needle, autoescape=True)
+
+    return db.session.query(model, score.label('score')) \
+        .filter(condition) \
+        .order_by(score.desc(), model.id) \
+        .limit(limit)
+
+
+def search_column(model, column, q, limit):
+    return search_query(model, column, q, limit,
+                        db.engine.dialect.name).all()
+
+
+def search_movies(q, limit):
+    return [
+        {'id': movie.id, 'title': movie.title, 'score': round(score, 3)}
+        for movie, score in search_column(Movie, Movie.title, q, limit)
+    ]
+
+
+def search_actors(q, limit):
+    return [
+        {
+            'id': actor.id,
+            'name': actor.name,
+            'movie_id': actor.movie_id,
+            'score': round(score, 3)
+        }
+        for actor, score in search_column(Actor, Actor.name, q, limit)
+    ]
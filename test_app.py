@@ -1,10 +1,115 @@
 import os
+import asyncio
+import gzip
+import multiprocessing
+import re
+import runpy
+import threading
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest import mock
+
+import click
+import rsa
+from flask import request, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from jose import jwk, jwt
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects import postgresql
+
+from app import create_app, response_cache
+from asgi import to_asgi
+import admission
+import batch
+import changes
+import replicas
+from auth import auth
+from cache import LRUBackend
+from search import search_query
+from warmup import warm_up
+from models import setup_db, db, Movie, Actor, ChangeEvent, bump_version, \
+    flush, get_versions, running_migrations
+from pool import InstrumentedQueuePool, engine_options, pool_status
+
+LOCAL_KID = 'local-test-key'
+LOCAL_PRIVATE_KEY = rsa.newkeys(1024)[1].save_pkcs1().decode()
+ALL_PERMISSIONS = [
+    'get:movies', 'post:movie', 'patch:movie', 'delete:movie',
+    'get:actors', 'post:actor', 'patch:actor', 'delete:actor',
+    'get:internal',
+]
+
+
+def local_jwks():
+    key = jwk.construct(LOCAL_PRIVATE_KEY, 'RS256').public_key().to_dict()
+    key.update({'kid': LOCAL_KID, 'use': 'sig'})
+    return {'keys': [key]}, None
+
+
+def mint_token(permissions=ALL_PERMISSIONS, ttl=3600,
+               subject='auth0|local-test-user'):
+    now = int(time.time())
+    return jwt.encode({
+        'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+        'sub': subject,
+        'aud': auth.API_AUDIENCE,
+        'iat': now,
+        'exp': now + ttl,
+        'permissions': permissions,
+    }, LOCAL_PRIVATE_KEY, algorithm='RS256', headers={'kid': LOCAL_KID})
+
+
+class LocalAgencyTestCase(unittest.TestCase):
+    '''Base for tests that run against an in-memory SQLite database with
+    tokens signed by a local key instead of Auth0 and PostgreSQL'''
+
+    database_url = 'sqlite://'
+
+    def setUp(self):
+        env = mock.patch.dict(os.environ)
+        env.start()
+        self.addCleanup(env.stop)
+        os.environ.pop('DATABASE_URL', None)
 
-from app import create_app
-from models import setup_db
+        fetch = mock.patch.object(auth.jwks_cache, 'fetch', local_jwks)
+        fetch.start()
+        self.addCleanup(fetch.stop)
+        auth.jwks_cache.clear()
+        self.addCleanup(auth.jwks_cache.clear)
+
+        backend = mock.patch.object(response_cache, 'backend', LRUBackend())
+        backend.start()
+        self.addCleanup(backend.stop)
+
+        self.app = create_app()
+        setup_db(self.app, self.database_url)
+        self.client = self.app.test_client
+
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.addCleanup(self.ctx.pop)
+        db.create_all()
+        self.addCleanup(db.session.remove)
+
+        self.headers = {"Authorization": f"Bearer {mint_token()}"}
+
+    def seed(self, movies=3, actors_per_movie=2):
+        for m in range(movies):
+            movie = Movie(title=f"Movie {m}",
+                          release_date=datetime(2020, 1, 1))
+            db.session.add(movie)
+            db.session.flush()
+            for a in range(actors_per_movie):
+                db.session.add(Actor(name=f"Actor {m}-{a}", age=30,
+                                     gender="F", movie_id=movie.id))
+        bump_version(Movie.__tablename__, Actor.__tablename__)
+        db.session.commit()
 
 
 class AgencyTestCase(unittest.TestCase):
@@ -278,5 +383,1533 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "unprocessable")
 
+class PaginationTestCase(LocalAgencyTestCase):
+    def test_movies_are_paged_by_cursor(self):
+        self.seed(movies=5, actors_per_movie=0)
+
+        res = self.client().get('/movies?limit=2', headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([m['id'] for m in data['movies']], [1, 2])
+        self.assertIsNotNone(data['next_cursor'])
+
+        seen = [m['id'] for m in data['movies']]
+        while data['next_cursor']:
+            res = self.client().get(
+                f"/movies?limit=2&cursor={data['next_cursor']}",
+                headers=self.headers)
+            data = json.loads(res.data)
+            seen += [m['id'] for m in data['movies']]
+
+        self.assertEqual(seen, [1, 2, 3, 4, 5])
+
+    def test_page_size_is_capped(self):
+        self.seed(movies=1, actors_per_movie=3)
+
+        with mock.patch('app.MAX_PAGE_SIZE', 2):
+            res = self.client().get('/actors?limit=1000',
+                                    headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(len(data['actors']), 2)
+        self.assertIsNotNone(data['next_cursor'])
+
+    def test_invalid_cursor_400(self):
+        res = self.client().get('/actors?cursor=not-a-cursor',
+                                headers=self.headers)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_invalid_limit_400(self):
+        res = self.client().get('/movies?limit=0', headers=self.headers)
+
+        self.assertEqual(res.status_code, 400)
+
+
+class QueryCountTestCase(LocalAgencyTestCase):
+    def count_queries(self, url, headers=None, status=200):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            res = self.client().get(url, headers=headers or self.headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+
+        self.assertEqual(res.status_code, status)
+        return len(statements)
+
+    def test_get_movies_query_count_is_constant(self):
+        # table versions, movies page, actors of those movies
+        self.seed(movies=2, actors_per_movie=1)
+        self.assertEqual(self.count_queries('/movies'), 3)
+
+        self.seed(movies=15, actors_per_movie=4)
+        self.assertEqual(self.count_queries('/movies'), 3)
+
+    def test_get_actors_query_count_is_constant(self):
+        # table versions, actors page
+        self.seed(movies=2, actors_per_movie=1)
+        self.assertEqual(self.count_queries('/actors'), 2)
+
+        self.seed(movies=10, actors_per_movie=5)
+        self.assertEqual(self.count_queries('/actors'), 2)
+
+    def test_not_modified_skips_main_query(self):
+        self.seed(movies=3, actors_per_movie=2)
+        res = self.client().get('/movies', headers=self.headers)
+        etag = res.headers['ETag']
+        headers = dict(self.headers, **{'If-None-Match': etag})
+
+        self.assertEqual(self.count_queries('/movies', headers, 304), 1)
+
+
+class ETagTestCase(LocalAgencyTestCase):
+    def get(self, url, etag=None):
+        headers = dict(self.headers)
+        if etag:
+            headers['If-None-Match'] = etag
+        return self.client().get(url, headers=headers)
+
+    def test_unchanged_list_is_not_modified(self):
+        self.seed(movies=2, actors_per_movie=1)
+        etag = self.get('/actors').headers['ETag']
+
+        res = self.get('/actors', etag)
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_write_changes_etag(self):
+        self.seed(movies=2, actors_per_movie=1)
+        movies_etag = self.get('/movies').headers['ETag']
+        actor_etag = self.get('/actors/1').headers['ETag']
+
+        self.client().patch('/actors/1', json={'name': 'Renamed'},
+                            headers=self.headers)
+
+        self.assertEqual(self.get('/movies', movies_etag).status_code, 200)
+        res = self.get('/actors/1', actor_etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['actor']['name'], 'Renamed')
+
+    def test_get_movie_404(self):
+        res = self.get('/movies/42')
+
+        self.assertEqual(res.status_code, 404)
+
+
+class ResponseCacheTestCase(LocalAgencyTestCase):
+    def test_repeat_list_is_served_from_cache(self):
+        self.seed(movies=2, actors_per_movie=2)
+        hits = response_cache.hits
+
+        first = self.client().get('/movies', headers=self.headers)
+        second = self.client().get('/movies', headers=self.headers)
+
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(response_cache.hits, hits + 1)
+        self.assertEqual(response_cache.backend.stats()['entries'], 1)
+
+    def test_write_invalidates_dependent_lists(self):
+        self.seed(movies=1, actors_per_movie=1)
+        self.client().get('/movies', headers=self.headers)
+        self.client().get('/actors', headers=self.headers)
+
+        self.client().patch('/actors/1', json={'name': 'Renamed'},
+                            headers=self.headers)
+
+        self.assertEqual(response_cache.backend.stats()['entries'], 0)
+        res = self.client().get('/movies', headers=self.headers)
+        self.assertEqual(json.loads(res.data)['movies'][0]['actors'],
+                         ['Renamed'])
+
+
+class PoolTestCase(unittest.TestCase):
+    def test_engine_options_from_env(self):
+        env = {
+            'DB_POOL_SIZE': '7', 'DB_MAX_OVERFLOW': '3',
+            'DB_POOL_PRE_PING': '0', 'DB_STATEMENT_TIMEOUT': '2500',
+        }
+        with mock.patch.dict(os.environ, env):
+            options = engine_options('postgresql://localhost/casting')
+
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['pool_size'], 7)
+        self.assertEqual(options['max_overflow'], 3)
+        self.assertFalse(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args']['options'],
+                         '-c statement_timeout=2500')
+        self.assertEqual(engine_options('sqlite://'), {})
+
+    def test_pool_status_reports_checkouts(self):
+        engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool,
+                               pool_size=2, max_overflow=1)
+        first = engine.connect()
+        second = engine.connect()
+        third = engine.connect()
+
+        status = pool_status(engine)
+        self.assertEqual(status['checked_out'], 3)
+        self.assertEqual(status['overflow'], 1)
+        self.assertEqual(status['checkouts'], 3)
+
+        for conn in (first, second, third):
+            conn.close()
+        self.assertEqual(pool_status(engine)['checked_out'], 0)
+
+    def test_pool_stats_are_kept_per_engine(self):
+        primary = create_engine('sqlite://',
+                                poolclass=InstrumentedQueuePool)
+        replica = create_engine('sqlite://',
+                                poolclass=InstrumentedQueuePool)
+        primary.connect().close()
+        primary.connect().close()
+        replica.connect().close()
+
+        self.assertEqual(pool_status(primary)['checkouts'], 2)
+        self.assertEqual(pool_status(replica)['checkouts'], 1)
+
+        # Disposing recreates the pool; its counters carry over.
+        primary.dispose()
+        primary.connect().close()
+        self.assertEqual(pool_status(primary)['checkouts'], 3)
+
+
+class QueryPlanTestCase(LocalAgencyTestCase):
+    '''Runs each endpoint against a large catalog and fails if any query
+    it issues has to scan a whole table'''
+
+    def setUp(self):
+        super().setUp()
+        movies = [{'title': f'Movie {i}', 'release_date': datetime(2020, 1, 1)}
+                  for i in range(2000)]
+        db.session.execute(Movie.__table__.insert(), movies)
+        actors = [{'name': f'Actor {i}', 'age': 30, 'gender': 'F',
+                   'movie_id': i % 2000 + 1} for i in range(20000)]
+        db.session.execute(Actor.__table__.insert(), actors)
+        bump_version(Movie.__tablename__, Actor.__tablename__)
+        db.session.commit()
+        db.session.execute('ANALYZE')
+
+    def capture(self, method, url, **kwargs):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  context, executemany):
+            if not executemany and not statement.startswith('INSERT'):
+                statements.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            res = getattr(self.client(), method)(
+                url, headers=self.headers, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+
+        self.assertEqual(res.status_code, 200)
+        return statements
+
+    def whole_table_scans(self, statement, plan):
+        '''The SCAN steps of `plan` that read movies or actors through
+        neither the primary key nor one of the models' indexes'''
+        indexes = {index.name for table in db.metadata.tables.values()
+                   for index in table.indexes}
+        statement = ' '.join(statement.split())
+        scans = []
+        for detail in plan:
+            words = detail.split()
+            # table_versions only has a row per table, so scanning it is
+            # fine.
+            if words[:1] != ['SCAN'] or words[1] not in ('movies',
+                                                          'actors'):
+                continue
+            if 'PRIMARY KEY' in detail:
+                continue
+            if words[2:4] == ['USING', 'INDEX'] and words[4] in indexes:
+                continue
+            if words[2:5] == ['USING', 'COVERING', 'INDEX'] and \
+                    words[5] in indexes:
+                continue
+            # SQLite shows a walk of the INTEGER PRIMARY KEY in order as a
+            # bare SCAN. Only a page with no WHERE, ordered by id and not
+            # re-sorted, is that walk stopping at its LIMIT.
+            if len(words) == 2 and ' WHERE ' not in statement and \
+                    f'ORDER BY {words[1]}.id LIMIT' in statement and \
+                    not any('TEMP B-TREE' in step for step in plan):
+                continue
+            scans.append(detail)
+        return scans
+
+    def assert_no_full_scans(self, statements):
+        self.assertTrue(statements)
+        for statement, parameters in statements:
+            plan = [row[-1] for row in db.session.connection()
+                    .exec_driver_sql('EXPLAIN QUERY PLAN ' + statement,
+                                     parameters).fetchall()]
+            self.assertEqual(self.whole_table_scans(statement, plan), [],
+                             statement)
+
+    def test_endpoint_queries_use_indexes(self):
+        cursor = json.loads(self.client().get(
+            '/movies', headers=self.headers).data)['next_cursor']
+        requests = [
+            ('get', '/movies', {}),
+            ('get', f'/movies?cursor={cursor}', {}),
+            ('get', '/movies?fields=title,actors', {}),
+            ('get', '/movies/1500', {}),
+            ('get', '/actors', {}),
+            ('get', f'/actors?cursor={cursor}', {}),
+            ('get', '/actors?fields=name,movie_id', {}),
+            ('get', '/actors/15000', {}),
+            ('patch', '/movies/1500', {'json': {'title': 'New title'}}),
+            ('patch', '/actors/15000', {'json': {'name': 'New name'}}),
+            ('patch', '/movies', {'json': {
+                'filter': {'title': 'Movie 7'},
+                'values': {'title': 'Movie 7b'}}}),
+            ('patch', '/actors', {'json': {
+                'filter': {'movie_id': [3, 4]}, 'values': {'age': 31}}}),
+            ('patch', '/actors', {'json': {
+                'filter': {'name': 'Actor 9'}, 'values': {'age': 32}}}),
+            ('patch', '/movies', {'json': {
+                'ids': [10, 11], 'values': {'title': 'Renamed'}}}),
+            ('delete', '/actors', {'json': {'filter': {'movie_id': 5}}}),
+            ('delete', '/actors', {'json': {'ids': [20, 21]}}),
+            ('delete', '/actors/15000', {}),
+            ('delete', '/movies/1500', {}),
+            ('delete', '/movies', {'json': {
+                'filter': {'release_date': '2021-01-01'}}}),
+        ]
+        for method, url, kwargs in requests:
+            with self.subTest(method=method, url=url):
+                response_cache.backend = LRUBackend()
+                self.assert_no_full_scans(self.capture(method, url, **kwargs))
+
+    def test_bare_scan_with_a_filter_is_caught(self):
+        statement = 'SELECT movies.id FROM movies WHERE movies.title ' \
+            'LIKE ? ORDER BY movies.id LIMIT ?'
+        self.assertEqual(self.whole_table_scans(statement, ['SCAN movies']),
+                         ['SCAN movies'])
+        self.assertEqual(self.whole_table_scans(
+            'SELECT movies.id FROM movies ORDER BY movies.title LIMIT ?',
+            ['SCAN movies', 'USE TEMP B-TREE FOR ORDER BY']),
+            ['SCAN movies'])
+
+    def test_search_uses_trigram_index_operators_on_postgresql(self):
+        # SQLite has no trigram index to plan against: its LIKE fallback
+        # reads the whole column. On PostgreSQL the GIN gin_trgm_ops
+        # indexes serve % and ILIKE (%% once compiled for psycopg2), so
+        # the only filter on each searched table must be those operators
+        # on the indexed column.
+        for model, column, index in ((Movie, Movie.title,
+                                      'ix_movies_title_trgm'),
+                                     (Actor, Actor.name,
+                                      'ix_actors_name_trgm')):
+            with self.subTest(index=index):
+                query = search_query(model, column, 'tom', 10, 'postgresql')
+                sql = ' '.join(str(query.statement.compile(
+                    dialect=postgresql.dialect())).split())
+                where = sql.split(' WHERE ')[1].split(' ORDER BY ')[0]
+                where = re.sub(r'%\(\w+\)s', '?', where)
+                name = f'{column.table.name}.{column.key}'
+                self.assertEqual(
+                    where, f"({name} %% ?) OR {name} ILIKE ? ESCAPE '\\\\'")
+
+
+class SearchTestCase(LocalAgencyTestCase):
+    def setUp(self):
+        super().setUp()
+        movie = Movie(title="Toy Story", release_date=datetime(1995, 1, 1))
+        db.session.add(movie)
+        db.session.add(Movie(title="Story of Tom",
+                             release_date=datetime(2001, 1, 1)))
+        db.session.flush()
+        for name in ("Tom Hanks", "Tom Cruise", "Atom Ant", "Meg Ryan"):
+            db.session.add(Actor(name=name, age=50, gender="M",
+                                 movie_id=movie.id))
+        db.session.commit()
+
+    def search(self, query):
+        res = self.client().get(f'/search?{query}', headers=self.headers)
+        return res.status_code, json.loads(res.data)
+
+    def test_prefix_matches_rank_first(self):
+        status, data = self.search('q=tom')
+
+        self.assertEqual(status, 200)
+        self.assertEqual([a['name'] for a in data['actors']],
+                         ['Tom Hanks', 'Tom Cruise', 'Atom Ant'])
+        self.assertEqual([m['title'] for m in data['movies']],
+                         ['Story of Tom'])
+
+    def test_results_are_bounded(self):
+        status, data = self.search('q=tom&type=actors&limit=1')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertNotIn('movies', data)
+
+    def test_like_wildcards_are_literal(self):
+        status, data = self.search('q=%25')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data['movies'], [])
+        self.assertEqual(data['actors'], [])
+
+    def test_missing_query_400(self):
+        status, data = self.search('q=')
+
+        self.assertEqual(status, 400)
+
+    def search_as(self, query, permissions):
+        token = mint_token(permissions=permissions)
+        res = self.client().get(f'/search?{query}', headers={
+            'Authorization': f'Bearer {token}'})
+        return res.status_code, json.loads(res.data)
+
+    def test_actor_search_needs_only_actor_permission(self):
+        status, data = self.search_as('q=tom&type=actors', ['get:actors'])
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data['actors']), 3)
+
+        status, data = self.search_as('q=tom&type=movies', ['get:actors'])
+
+        self.assertEqual(status, 403)
+
+    def test_search_all_covers_the_readable_tables(self):
+        status, data = self.search_as('q=tom', ['get:actors'])
+
+        self.assertEqual(status, 200)
+        self.assertNotIn('movies', data)
+        self.assertEqual(len(data['actors']), 3)
+
+        status, data = self.search_as('q=tom', ['get:movies'])
+
+        self.assertEqual(status, 200)
+        self.assertNotIn('actors', data)
+        self.assertEqual(len(data['movies']), 1)
+
+        status, data = self.search_as('q=tom', ['post:actor'])
+
+        self.assertEqual(status, 403)
+
+    def test_short_query_400_on_postgresql(self):
+        status, data = self.search('q=to')
+
+        self.assertEqual(status, 200)
+
+        with mock.patch.object(db.engine.dialect, 'name', 'postgresql'):
+            status, data = self.search('q=to')
+
+        self.assertEqual(status, 400)
+
+
+class ASGITestCase(LocalAgencyTestCase):
+    '''Uses a SQLite file so requests on different handler threads get
+    connections of their own'''
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.database_url = 'sqlite:///' + os.path.join(tmpdir.name, 'a.db')
+        super().setUp()
+        self.addCleanup(db.engine.dispose)
+        self.adapter = to_asgi(self.app, threads=4)
+        self.addCleanup(self.adapter.executor.shutdown)
+
+    def call(self, method, path, body=b'', headers=None):
+        headers = dict(self.headers, **(headers or {}))
+        scope = {
+            'type': 'http',
+            'http_version': '1.1',
+            'method': method,
+            'path': path.split('?')[0],
+            'query_string': path.partition('?')[2].encode(),
+            'headers': [(k.lower().encode(), v.encode())
+                        for k, v in headers.items()],
+        }
+        received = [{'type': 'http.request', 'body': body}]
+        sent = []
+
+        async def receive():
+            return received.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        async def run():
+            await self.adapter(scope, receive, send)
+
+        return run, sent
+
+    def response(self, sent):
+        status = sent[0]['status']
+        body = b''.join(m.get('body', b'') for m in sent[1:])
+        return status, body
+
+    def test_routes_are_served_over_asgi(self):
+        self.seed(movies=3, actors_per_movie=1)
+
+        get_movies, movies_sent = self.call('GET', '/movies?limit=2')
+        post_actor, actor_sent = self.call(
+            'POST', '/actors', headers={'Content-Type': 'application/json'},
+            body=json.dumps({"name": "New", "age": 40, "gender": "F",
+                             "movie_id": 1}).encode())
+
+        async def run_both():
+            await asyncio.gather(get_movies(), post_actor())
+
+        asyncio.run(run_both())
+
+        status, body = self.response(movies_sent)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body)['movies']), 2)
+        status, body = self.response(actor_sent)
+        self.assertEqual(status, 200)
+        self.assertEqual(Actor.query.count(), 4)
+
+    def test_handlers_run_concurrently(self):
+        self.seed(movies=1, actors_per_movie=1)
+        together = threading.Barrier(3, timeout=5)
+
+        @self.app.route('/test/together')
+        def wait_for_others():
+            together.wait()
+            return jsonify({"success": True, "actors": Actor.query.count()})
+
+        calls = [self.call('GET', '/test/together') for _ in range(3)]
+
+        async def run_all():
+            await asyncio.gather(*(run() for run, _ in calls))
+
+        asyncio.run(run_all())
+
+        for _, sent in calls:
+            status, body = self.response(sent)
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body)['actors'], 1)
+
+    def test_streamed_response_arrives_in_chunks(self):
+        self.seed(movies=4, actors_per_movie=0)
+
+        run, sent = self.call('GET', '/movies',
+                              headers={'Accept': 'application/x-ndjson'})
+        asyncio.run(run())
+
+        status, body = self.response(sent)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(body.splitlines()), 4)
+        self.assertGreater(len(sent), 4)
+
+    def test_auth_errors_keep_their_status(self):
+        run, sent = self.call('DELETE', '/actors/1', headers={
+            'Authorization': f"Bearer {mint_token(['get:actors'])}"})
+        asyncio.run(run())
+
+        self.assertEqual(self.response(sent)[0], 403)
+
+
+class BulkCreateTestCase(LocalAgencyTestCase):
+    def test_create_movies_bulk(self):
+        movies = [
+            {"title": f"Bulk {i}", "release_date": "2021-06-0{}".format(i)}
+            for i in range(1, 4)
+        ]
+        res = self.client().post('/movies/bulk', json=movies,
+                                 headers=self.headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["created_movie_ids"], [1, 2, 3])
+        self.assertEqual(Movie.query.count(), 3)
+
+    def test_create_actors_bulk_ndjson(self):
+        self.seed(movies=1, actors_per_movie=0)
+        lines = "\n".join(json.dumps({
+            "name": f"Actor {i}", "age": 20 + i, "gender": "M",
+            "movie_id": 1,
+        }) for i in range(5))
+
+        res = self.client().post(
+            '/actors/bulk', data=lines, headers=self.headers,
+            content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["total_created"], 5)
+        self.assertEqual(Actor.query.count(), 5)
+
+    def test_invalid_row_rejects_whole_batch(self):
+        actors = [
+            {"name": "Ok", "age": 30, "gender": "F", "movie_id": 1},
+            {"name": "Missing age", "gender": "F", "movie_id": 1},
+        ]
+        res = self.client().post('/actors/bulk', json=actors,
+                                 headers=self.headers)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(Actor.query.count(), 0)
+
+    def test_bulk_create_requires_permission(self):
+        headers = {"Authorization": f"Bearer {mint_token(['get:movies'])}"}
+        res = self.client().post(
+            '/movies/bulk', headers=headers,
+            json=[{"title": "x", "release_date": "2021-01-01"}])
+
+        self.assertEqual(res.status_code, 403)
+
+
+class StreamingTestCase(LocalAgencyTestCase):
+    def test_movies_stream_as_ndjson(self):
+        self.seed(movies=7, actors_per_movie=2)
+        headers = dict(self.headers, Accept='application/x-ndjson')
+
+        with mock.patch('app.STREAM_BATCH_SIZE', 3), \
+                mock.patch('app.MAX_PAGE_SIZE', 2):
+            res = self.client().get('/movies', headers=headers)
+            lines = res.get_data(as_text=True).splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        movies = [json.loads(line) for line in lines]
+        self.assertEqual([m['id'] for m in movies], list(range(1, 8)))
+        self.assertEqual(len(movies[0]['actors']), 2)
+
+    def test_actors_stream_resumes_from_cursor(self):
+        self.seed(movies=2, actors_per_movie=3)
+        headers = dict(self.headers, Accept='application/x-ndjson')
+
+        page = json.loads(self.client().get(
+            '/actors?limit=4', headers=self.headers).data)
+        res = self.client().get(f"/actors?cursor={page['next_cursor']}",
+                                headers=headers)
+        actors = [json.loads(line) for line in
+                  res.get_data(as_text=True).splitlines()]
+
+        self.assertEqual([a['id'] for a in actors], [5, 6])
+
+
+class MetricsTestCase(LocalAgencyTestCase):
+    def test_server_timing_breaks_down_phases(self):
+        self.seed()
+        res = self.client().get('/movies', headers=self.headers)
+
+        phases = dict(entry.split(';dur=') for entry in
+                      res.headers['Server-Timing'].split(', '))
+        for phase in ('auth', 'jwks', 'jwt', 'db', 'serialize', 'total'):
+            self.assertIn(phase, phases)
+        self.assertGreaterEqual(float(phases['total']),
+                                float(phases['db']))
+
+    def test_internal_endpoints_need_internal_permission(self):
+        reader = {"Authorization": f"Bearer {mint_token(['get:movies'])}"}
+        for path in ('/metrics', '/internal/cache', '/internal/pool'):
+            with self.subTest(path=path):
+                self.assertEqual(self.client().get(path).status_code, 401)
+                self.assertEqual(
+                    self.client().get(path, headers=reader).status_code, 403)
+                self.assertEqual(
+                    self.client().get(path, headers=self.headers)
+                    .status_code, 200)
+
+    def test_metrics_are_labeled_by_route_status_and_permission(self):
+        self.client().get('/movies/999', headers=self.headers)
+        body = self.client().get('/metrics', headers=self.headers) \
+            .get_data(as_text=True)
+
+        self.assertIn('http_requests_total{route="/movies/<int:movie_id>",'
+                      'method="GET",status="404",permission="get:movies"}',
+                      body)
+        self.assertIn('http_request_phase_seconds_count{'
+                      'route="/movies/<int:movie_id>",phase="db"}', body)
+        self.assertIn('casting_token_cache_misses', body)
+
+
+class SerializationTestCase(LocalAgencyTestCase):
+    def test_format_rows_matches_format(self):
+        self.seed(movies=3, actors_per_movie=2)
+
+        movies = Movie.query.order_by(Movie.id).all()
+        self.assertEqual(Movie.format_rows(Movie.row_query()
+                                           .order_by(Movie.id)),
+                         [movie.format() for movie in movies])
+        actors = Actor.query.order_by(Actor.id).all()
+        self.assertEqual(Actor.format_rows(Actor.row_query()
+                                           .order_by(Actor.id)),
+                         [actor.format() for actor in actors])
+
+    def test_dates_are_iso_8601_everywhere(self):
+        self.seed(movies=1)
+
+        page = json.loads(self.client().get('/movies',
+                                            headers=self.headers).data)
+        single = json.loads(self.client().get('/movies/1',
+                                              headers=self.headers).data)
+
+        self.assertEqual(page['movies'][0]['release_date'],
+                         '2020-01-01T00:00:00')
+        self.assertEqual(single['movie']['release_date'],
+                         '2020-01-01T00:00:00')
+
+
+class SparseFieldsetTestCase(LocalAgencyTestCase):
+    def get_with_statements(self, url, headers=None):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            res = self.client().get(url, headers=headers or self.headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        return res, statements
+
+    def test_movies_fields_skip_actors(self):
+        self.seed(movies=3, actors_per_movie=2)
+
+        res, statements = self.get_with_statements('/movies?fields=title')
+        movies = json.loads(res.data)['movies']
+
+        self.assertEqual(movies[0], {'id': 1, 'title': 'Movie 0'})
+        # table versions and the movies page, no actors query
+        self.assertEqual(len(statements), 2)
+        self.assertNotIn('release_date', statements[1])
+        self.assertNotIn('actors', statements[1])
+
+    def test_actors_fields_project_columns(self):
+        self.seed(movies=1, actors_per_movie=2)
+
+        res, statements = self.get_with_statements(
+            '/actors?fields=name,movie_id')
+        actors = json.loads(res.data)['actors']
+
+        self.assertEqual(actors[0], {'id': 1, 'name': 'Actor 0-0',
+                                     'movie_id': 1})
+        self.assertNotIn('gender', statements[-1])
+        self.assertNotIn('age', statements[-1])
+
+    def test_fields_apply_to_streams(self):
+        self.seed(movies=2, actors_per_movie=1)
+        headers = dict(self.headers, Accept='application/x-ndjson')
+
+        res = self.client().get('/movies?fields=id', headers=headers)
+        lines = res.get_data(as_text=True).splitlines()
+
+        self.assertEqual([json.loads(line) for line in lines],
+                         [{'id': 1}, {'id': 2}])
+
+    def test_unknown_field_400(self):
+        res = self.client().get('/movies?fields=title,budget',
+                                headers=self.headers)
+        self.assertEqual(res.status_code, 400)
+
+
+class BatchWriteTestCase(LocalAgencyTestCase):
+    def send(self, method, url, body):
+        return self.client().open(url, method=method, json=body,
+                                  headers=self.headers)
+
+    def test_patch_actors_by_ids(self):
+        self.seed(movies=2, actors_per_movie=2)
+
+        res = self.send('PATCH', '/actors', {"ids": [1, 3, 99],
+                                             "values": {"movie_id": 2}})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated_actor_ids'], [1, 3])
+        self.assertEqual(
+            [a.movie_id for a in Actor.query.order_by(Actor.id)],
+            [2, 1, 2, 2])
+
+    def test_patch_movies_by_filter(self):
+        self.seed(movies=3, actors_per_movie=0)
+
+        res = self.send('PATCH', '/movies', {
+            "filter": {"title": ["Movie 0", "Movie 2"]},
+            "values": {"release_date": "2021-06-01"}})
+        data = json.loads(res.data)
+
+        self.assertEqual(data['updated_movie_ids'], [1, 3])
+        self.assertEqual(db.session.get(Movie, 3).release_date,
+                         datetime(2021, 6, 1))
+
+    def test_only_date_columns_parse_dates(self):
+        self.seed(movies=1, actors_per_movie=0)
+
+        res = self.send('PATCH', '/movies', {
+            "ids": [1], "values": {"title": "2046-05-01"}})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(db.session.get(Movie, 1).title, '2046-05-01')
+
+        res = self.send('PATCH', '/movies', {
+            "filter": {"title": "2046-05-01",
+                       "release_date": "2020-01-01"},
+            "values": {"title": "In the mood for love"}})
+        self.assertEqual(json.loads(res.data)['updated_movie_ids'], [1])
+
+    def test_patch_is_one_statement(self):
+        self.seed(movies=1, actors_per_movie=50)
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            if statement.startswith('UPDATE actors'):
+                statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                        before_cursor_execute)
+        res = self.send('PATCH', '/actors', {"filter": {"movie_id": 1},
+                                             "values": {"age": 31}})
+
+        self.assertEqual(json.loads(res.data)['total_updated'], 50)
+        self.assertEqual(len(statements), 1)
+
+    def test_delete_movies_orphans_their_actors(self):
+        self.seed(movies=3, actors_per_movie=1)
+        etag = self.client().get('/actors',
+                                 headers=self.headers).headers['ETag']
+
+        res = self.send('DELETE', '/movies', {"ids": [1, 2]})
+
+        self.assertEqual(json.loads(res.data)['deleted_movie_ids'], [1, 2])
+        self.assertEqual(Movie.query.count(), 1)
+        self.assertEqual(
+            [a.movie_id for a in Actor.query.order_by(Actor.id)],
+            [None, None, 3])
+        self.assertNotEqual(self.client().get(
+            '/actors', headers=self.headers).headers['ETag'], etag)
+
+    def test_delete_actors_by_filter(self):
+        self.seed(movies=2, actors_per_movie=2)
+
+        res = self.send('DELETE', '/actors', {"filter": {"movie_id": 2}})
+
+        self.assertEqual(json.loads(res.data)['deleted_actor_ids'], [3, 4])
+        self.assertEqual(Actor.query.count(), 2)
+
+    def test_invalid_selection_400(self):
+        for body in ({}, {"filter": {}}, {"ids": []},
+                     {"ids": [1], "filter": {"age": 30}},
+                     {"filter": {"salary": 1}}):
+            with self.subTest(body=body):
+                res = self.send('DELETE', '/actors', body)
+                self.assertEqual(res.status_code, 400)
+
+    def test_patch_without_values_422(self):
+        res = self.send('PATCH', '/actors', {"ids": [1], "values": {}})
+        self.assertEqual(res.status_code, 422)
+
+
+class UnitOfWorkTestCase(LocalAgencyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.commits = []
+
+        def on_commit(conn):
+            self.commits.append(conn)
+
+        event.listen(db.engine, 'commit', on_commit)
+        self.addCleanup(event.remove, db.engine, 'commit', on_commit)
+
+        @self.app.route('/test/cast', methods=['POST'])
+        def cast():
+            movie = Movie(title='Ensemble', release_date=datetime(2020, 1, 1))
+            movie.insert()
+            flush()
+            for i in range(5):
+                Actor(name=f'Extra {i}', age=30, gender='F',
+                      movie_id=movie.id).insert()
+            if request.args.get('fail'):
+                abort(400)
+            return jsonify({"success": True, "movie_id": movie.id})
+
+    def test_request_commits_once(self):
+        res = self.client().post('/test/cast')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(self.commits), 1)
+        self.assertEqual(Actor.query.filter_by(
+            movie_id=json.loads(res.data)['movie_id']).count(), 5)
+        self.assertEqual(get_versions('movies', 'actors'),
+                         {'movies': 1, 'actors': 1})
+
+    def test_error_response_rolls_back(self):
+        res = self.client().post('/test/cast?fail=1')
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.commits, [])
+        self.assertEqual(Movie.query.count(), 0)
+        self.assertEqual(Actor.query.count(), 0)
+
+    def test_reads_do_not_commit(self):
+        self.seed()
+        del self.commits[:]
+        self.client().get('/actors', headers=self.headers)
+        self.assertEqual(self.commits, [])
+
+
+class ReplicaTestCase(LocalAgencyTestCase):
+    '''The in-memory database is the primary; a SQLite file holding
+    different rows stands in for the replica'''
+
+    def setUp(self):
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.replica_url = 'sqlite:///' + os.path.join(tmpdir.name, 'r.db')
+
+        replica = create_engine(self.replica_url)
+        db.metadata.create_all(replica)
+        with replica.begin() as conn:
+            conn.execute(Movie.__table__.insert(),
+                         {'title': 'Replica', 'release_date': datetime.now()})
+            conn.execute(Actor.__table__.insert(),
+                         {'name': 'On replica', 'age': 40, 'gender': 'M',
+                          'movie_id': 1})
+        replica.dispose()
+        self.seed(movies=1, actors_per_movie=1)
+
+    def names(self, headers=None):
+        res = self.client().get('/actors', headers=headers or self.headers)
+        return [actor['name'] for actor in json.loads(res.data)['actors']]
+
+    def test_reads_go_to_replica_and_writes_to_primary(self):
+        replicas.init_app(self.app, db, [self.replica_url])
+
+        self.assertEqual(self.names(), ['On replica'])
+        res = self.client().post('/actors', headers=self.headers, json={
+            "name": "New", "age": 30, "gender": "F", "movie_id": 1})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(replicas.STICKY_COOKIE, res.headers['Set-Cookie'])
+        self.assertEqual(Actor.query.count(), 2)
+
+    def test_client_reads_its_own_writes(self):
+        replicas.init_app(self.app, db, [self.replica_url])
+        other = {"Authorization": f"Bearer {mint_token(ttl=7200)}"}
+
+        self.client().patch('/actors/1', headers=self.headers,
+                            json={"age": 31})
+
+        self.assertEqual(self.names(), ['Actor 0-0'])
+        self.assertEqual(self.names(other), ['On replica'])
+        with mock.patch('time.monotonic',
+                        return_value=time.monotonic() + 60):
+            self.assertEqual(self.names(), ['On replica'])
+
+    def test_batch_reads_see_clients_own_writes(self):
+        replicas.init_app(self.app, db, [self.replica_url])
+
+        self.client().patch('/actors/1', headers=self.headers,
+                            json={"age": 31})
+        res = self.client().post('/batch', headers=self.headers, json={
+            "requests": [{"method": "GET", "path": "/actors"}]})
+
+        actors = json.loads(res.data)['responses'][0]['body']['actors']
+        self.assertEqual([actor['name'] for actor in actors], ['Actor 0-0'])
+
+    def test_read_only_batch_keeps_reads_on_replica(self):
+        replicas.init_app(self.app, db, [self.replica_url])
+
+        res = self.client().post('/batch', headers=self.headers, json={
+            "requests": [{"method": "GET", "path": "/actors"},
+                         {"method": "DELETE", "path": "/actors/99"}]})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Set-Cookie', res.headers)
+        self.assertEqual(self.names(), ['On replica'])
+
+    def test_unreachable_replica_falls_back_to_primary(self):
+        down = replicas.init_app(
+            self.app, db, ['sqlite:////nonexistent/dir/replica.db'])
+
+        self.assertEqual(self.names(), ['Actor 0-0'])
+        self.assertFalse(down.status()[0]['healthy'])
+
+    def test_pool_view_reports_each_replica_pool(self):
+        replicas.init_app(self.app, db, [self.replica_url])
+
+        res = self.client().get('/internal/pool', headers=self.headers)
+
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('class', data['pool'])
+        self.assertEqual(data['replicas'][0]['pool']['class'],
+                         type(self.app.extensions['replicas']
+                              .engines[0].pool).__name__)
+
+
+class CompressionTestCase(LocalAgencyTestCase):
+    def get(self, url, encoding='gzip', **headers):
+        headers = dict(self.headers, **headers)
+        if encoding:
+            headers['Accept-Encoding'] = encoding
+        return self.client().get(url, headers=headers)
+
+    def test_large_list_is_gzipped(self):
+        self.seed(movies=10, actors_per_movie=5)
+
+        res = self.get('/actors?limit=50')
+        plain = self.get('/actors?limit=50', encoding=None)
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertLess(len(res.data), len(plain.data))
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+    def test_small_body_is_not_compressed(self):
+        res = self.get('/test')
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_refused_encoding_is_not_used(self):
+        self.seed(movies=10, actors_per_movie=5)
+        res = self.get('/actors?limit=50', encoding='gzip;q=0, identity')
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_stream_is_compressed_incrementally(self):
+        self.seed(movies=30, actors_per_movie=1)
+
+        with mock.patch('compress.COMPRESS_FLUSH_SIZE', 200):
+            res = self.get('/actors', Accept='application/x-ndjson')
+            chunks = list(res.response)
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertGreater(len(chunks), 2)
+        lines = gzip.decompress(b''.join(chunks)).splitlines()
+        self.assertEqual(len(lines), 30)
+
+    def test_compressed_etag_still_revalidates(self):
+        self.seed(movies=10, actors_per_movie=5)
+        etag = self.get('/actors?limit=50').headers['ETag']
+
+        res = self.get('/actors?limit=50', **{'If-None-Match': etag})
+
+        self.assertTrue(etag.startswith('W/'))
+        self.assertEqual(res.status_code, 304)
+
+
+class ChangeFeedTestCase(LocalAgencyTestCase):
+    def setUp(self):
+        super().setUp()
+        duration = mock.patch('changes.CHANGES_MAX_DURATION', 0.2)
+        duration.start()
+        self.addCleanup(duration.stop)
+
+    def events(self, response):
+        events = []
+        for chunk in response.response:
+            chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+            for block in chunk.split('\n\n'):
+                lines = dict(line.split(': ', 1)
+                             for line in block.splitlines()
+                             if ': ' in line and not line.startswith(':'))
+                if 'data' in lines:
+                    event = json.loads(lines['data'])
+                    self.assertEqual(int(lines['id']), event['id'])
+                    events.append(event)
+        return events
+
+    def test_writes_record_events(self):
+        self.seed(movies=2, actors_per_movie=1)
+        self.client().patch('/actors/1', headers=self.headers,
+                            json={"age": 50})
+        self.client().delete('/movies', headers=self.headers,
+                             json={"ids": [2]})
+
+        events = [e.format() for e in ChangeEvent.query.order_by('id')]
+        ops = [(e['table'], e['op'], e['ids']) for e in events]
+        self.assertEqual(ops, [
+            ('movies', 'insert', [1, 2]),
+            ('actors', 'insert', [1, 2]),
+            ('actors', 'update', [1]),
+            ('actors', 'update', [2]),
+            ('movies', 'delete', [2]),
+        ])
+
+    def test_missed_events_are_replayed(self):
+        self.seed(movies=1, actors_per_movie=1)
+        self.client().post('/actors', headers=self.headers, json={
+            "name": "New", "age": 30, "gender": "F", "movie_id": 1})
+
+        res = self.client().get('/changes', headers=dict(
+            self.headers, **{'Last-Event-ID': '1'}))
+
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        events = self.events(res)
+        self.assertEqual([(e['table'], e['op'], e['ids']) for e in events],
+                         [('actors', 'insert', [1]),
+                          ('actors', 'insert', [2])])
+
+    def test_truncated_replay_ends_the_stream(self):
+        self.seed(movies=1, actors_per_movie=1)
+
+        with mock.patch('changes.CHANGES_REPLAY_LIMIT', 1):
+            res = self.client().get('/changes?last_event_id=0',
+                                    headers=self.headers)
+            self.client().post('/movies', headers=self.headers, json={
+                "title": "Live", "release_date": "2021-01-01"})
+            events = self.events(res)
+
+        # The live movie insert would have skipped the actor insert.
+        self.assertEqual([e['id'] for e in events], [1])
+        self.assertEqual(changes.broker.subscribers, set())
+
+    def test_live_events_are_pushed(self):
+        res = self.client().get('/changes?tables=actors',
+                                headers=self.headers)
+        self.client().post('/movies', headers=self.headers, json={
+            "title": "Live", "release_date": "2021-01-01"})
+        self.client().post('/actors', headers=self.headers, json={
+            "name": "Live", "age": 30, "gender": "F", "movie_id": 1})
+
+        events = self.events(res)
+
+        self.assertEqual(len(events), 1)
+        self.assertEqual((events[0]['table'], events[0]['op']),
+                         ('actors', 'insert'))
+        self.assertEqual(changes.broker.subscribers, set())
+
+    def test_subscribers_are_limited_per_process(self):
+        # Half of the default 8 threads, so a few tabs per worker fit.
+        self.assertEqual(changes.broker.max_subscribers, 4)
+        with mock.patch.object(changes.broker, 'max_subscribers', 1):
+            first = self.client().get('/changes', headers=self.headers)
+            second = self.client().get('/changes', headers=self.headers)
+            self.assertEqual(second.status_code, 503)
+            self.assertEqual(second.headers['Retry-After'], '1')
+            text = self.client().get('/metrics', headers=self.headers) \
+                .get_data(as_text=True)
+            self.assertIn('casting_changes_subscribers 1', text)
+
+            # Closing a stream early frees its slot.
+            first.close()
+            self.assertEqual(changes.broker.subscribers, set())
+            third = self.client().get('/changes', headers=self.headers)
+            self.assertEqual(third.status_code, 200)
+            self.events(third)
+
+    def test_commits_are_published_until_listener_is_listening(self):
+        subscriber = changes.broker.subscribe()
+        self.addCleanup(changes.broker.unsubscribe, subscriber)
+        listener = changes.PostgresListener(db.engine, changes.broker)
+
+        with mock.patch.object(changes, 'listener', listener):
+            self.seed(movies=1, actors_per_movie=0)
+            self.assertEqual(subscriber.get_nowait()['table'], 'movies')
+
+            listener.listening.set()
+            self.seed(movies=1, actors_per_movie=0)
+            self.assertTrue(subscriber.empty())
+
+    def test_listener_catches_up_on_missed_notifications(self):
+        self.seed(movies=1, actors_per_movie=0)
+        listener = changes.PostgresListener(db.engine, changes.broker,
+                                            last_id=1)
+        listener.listening.set()
+        subscriber = changes.broker.subscribe()
+        self.addCleanup(changes.broker.unsubscribe, subscriber)
+
+        # Committed while the listener was reconnecting: nothing notified.
+        with mock.patch.object(changes, 'listener', listener):
+            self.seed(movies=1, actors_per_movie=1)
+        self.assertTrue(subscriber.empty())
+
+        listener.catch_up()
+        listener.publish(listener.load([2, 3]))
+        listener.catch_up()
+
+        events = [subscriber.get_nowait() for _ in range(2)]
+        self.assertEqual([event['id'] for event in events], [2, 3])
+        self.assertTrue(subscriber.empty())
+        self.assertEqual(listener.last_id, 3)
+
+    def test_listener_ends_streams_it_cannot_catch_up(self):
+        broker = changes.Broker(maxsize=2)
+        subscriber = broker.subscribe()
+        listener = changes.PostgresListener(db.engine, broker)
+        self.seed(movies=2, actors_per_movie=1)
+
+        listener.catch_up()
+
+        self.assertIs(subscriber.get_nowait(), changes.OVERFLOW)
+        self.assertEqual(broker.subscribers, set())
+        self.assertEqual(listener.last_id, 2)
+
+    def test_actor_events_need_actor_permission(self):
+        self.seed(movies=1, actors_per_movie=1)
+        token = mint_token(permissions=['get:movies'])
+
+        res = self.client().get('/changes?last_event_id=0', headers={
+            "Authorization": f"Bearer {token}"})
+
+        self.assertEqual([e['table'] for e in self.events(res)],
+                         ['movies'])
+
+        res = self.client().get('/changes?tables=actors', headers={
+            "Authorization": f"Bearer {token}"})
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(changes.broker.subscribers, set())
+
+
+class BatchTestCase(LocalAgencyTestCase):
+    '''Uses a SQLite file so concurrent reads get connections of their
+    own rather than sharing the single in-memory one'''
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.database_url = 'sqlite:///' + os.path.join(tmpdir.name, 'b.db')
+        super().setUp()
+        self.addCleanup(db.engine.dispose)
+        self.seed(movies=2, actors_per_movie=1)
+        auth.token_cache.clear()
+
+    def batch(self, requests, headers=None, **options):
+        res = self.client().post('/batch', headers=headers or self.headers,
+                                 json=dict(options, requests=requests))
+        return res.status_code, json.loads(res.data)
+
+    def test_token_is_verified_once(self):
+        with mock.patch.object(auth, 'verify_decode_jwt',
+                               wraps=auth.verify_decode_jwt) as verify, \
+                mock.patch.object(batch, 'get_executor',
+                                  wraps=batch.get_executor) as pool:
+            status, data = self.batch([
+                {"method": "GET", "path": "/movies"},
+                {"method": "GET", "path": "/actors/1"},
+                {"method": "GET", "path": "/actors/2"},
+            ])
+
+        self.assertEqual(status, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual([r['status'] for r in data['responses']],
+                         [200, 200, 200])
+        self.assertEqual(data['responses'][2]['body']['actor']['name'],
+                         'Actor 1-0')
+        self.assertEqual(verify.call_count, 1)
+        self.assertTrue(pool.called)
+
+    def test_reads_follow_earlier_writes(self):
+        status, data = self.batch([
+            {"method": "PATCH", "path": "/actors/1", "body": {"age": 41}},
+            {"method": "GET", "path": "/actors/1"},
+            {"method": "GET", "path": "/actors/2"},
+        ])
+
+        self.assertTrue(data['success'])
+        self.assertNotIn('committed', data)
+        self.assertEqual(data['responses'][1]['body']['actor']['age'], 41)
+        self.assertEqual(db.session.get(Actor, 1).age, 41)
+
+    def test_permissions_are_checked_per_request(self):
+        token = mint_token(permissions=['get:movies', 'get:actors'])
+
+        status, data = self.batch([
+            {"method": "GET", "path": "/movies"},
+            {"method": "DELETE", "path": "/actors/1"},
+        ], headers={"Authorization": f"Bearer {token}"})
+
+        self.assertEqual(status, 200)
+        self.assertFalse(data['success'])
+        self.assertEqual([r['status'] for r in data['responses']],
+                         [200, 403])
+        self.assertEqual(Actor.query.count(), 2)
+
+    def test_transaction_rolls_back_on_failure(self):
+        status, data = self.batch([
+            {"method": "PATCH", "path": "/actors/1", "body": {"age": 50}},
+            {"method": "PATCH", "path": "/actors/99", "body": {"age": 50}},
+            {"method": "DELETE", "path": "/movies/2"},
+        ], transaction=True)
+
+        self.assertEqual(status, 200)
+        self.assertFalse(data['committed'])
+        self.assertEqual([r['status'] for r in data['responses']],
+                         [200, 404, 424])
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Actor, 1).age, 30)
+        self.assertEqual(Movie.query.count(), 2)
+
+    def test_transaction_commits_once(self):
+        commits = []
+
+        def on_commit(conn):
+            commits.append(conn)
+
+        event.listen(db.engine, 'commit', on_commit)
+        self.addCleanup(event.remove, db.engine, 'commit', on_commit)
+
+        status, data = self.batch([
+            {"method": "PATCH", "path": "/actors/1", "body": {"age": 50}},
+            {"method": "GET", "path": "/actors/1"},
+            {"method": "DELETE", "path": "/actors/2"},
+        ], transaction=True)
+
+        self.assertTrue(data['committed'])
+        self.assertEqual(data['responses'][1]['body']['actor']['age'], 50)
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(Actor.query.count(), 1)
+
+    def test_rolled_back_reads_are_not_cached(self):
+        status, data = self.batch([
+            {"method": "PATCH", "path": "/movies/1",
+             "body": {"title": "PHANTOM"}},
+            {"method": "GET", "path": "/movies"},
+            {"method": "DELETE", "path": "/movies/99"},
+        ], transaction=True)
+
+        self.assertFalse(data['committed'])
+        self.assertEqual(data['responses'][1]['body']['movies'][0]['title'],
+                         'PHANTOM')
+        res = self.client().get('/movies', headers=self.headers)
+        self.assertEqual(json.loads(res.data)['movies'][0]['title'],
+                         'Movie 0')
+
+    def test_rejects_invalid_batches(self):
+        status, _ = self.batch([{"method": "POST", "path": "/batch"}])
+        self.assertEqual(status, 400)
+
+        status, _ = self.batch([{"method": "GET", "path": "/movies"}] *
+                               (batch.MAX_BATCH_REQUESTS + 1))
+        self.assertEqual(status, 413)
+
+        res = self.client().post('/batch', json={"requests": []})
+        self.assertEqual(res.status_code, 401)
+
+
+class StartupTestCase(LocalAgencyTestCase):
+    def test_importing_app_builds_nothing(self):
+        output = subprocess.run([sys.executable, '-c', (
+            "import sys, app; "
+            "print(hasattr(app, 'app'), 'alembic' in sys.modules)")],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual(output.split(), ['False', 'False'])
+
+    def test_migrate_is_only_registered_for_flask_db(self):
+        from flask_migrate import cli
+
+        self.assertNotIn('migrate', self.app.extensions)
+        with click.Context(cli.db, info_name='db') as group:
+            with click.Context(cli.upgrade, parent=group):
+                self.assertTrue(running_migrations())
+        # uvicorn and `flask run` build the app inside click commands too.
+        with click.Context(click.Command('run')):
+            self.assertFalse(running_migrations())
+
+    def test_warm_up_compiles_hot_queries(self):
+        self.seed()
+        db.session.remove()
+
+        timings = warm_up(self.app)
+
+        self.assertEqual(set(timings), {'jwks', 'connections', 'queries'})
+        self.assertEqual(auth.jwks_cache.stats()['keys'], 1)
+        compiled = len(db.engine._compiled_cache)
+        for path in ('/movies', '/movies?cursor=MQ', '/movies/1',
+                     '/actors', '/actors/1'):
+            res = self.client().get(path, headers=self.headers)
+            self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(db.engine._compiled_cache), compiled)
+
+    def test_failed_step_does_not_stop_warm_up(self):
+        def unreachable():
+            raise OSError('IdP unreachable')
+
+        with mock.patch.object(auth.jwks_cache, 'fetch', unreachable), \
+                self.assertLogs(self.app.logger, 'WARNING'):
+            timings = warm_up(self.app)
+
+        self.assertIn('queries', timings)
+
+
+class GunicornConfigTestCase(LocalAgencyTestCase):
+    def config(self, **env):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'gunicorn.conf.py')
+        with mock.patch.dict(os.environ, env):
+            # Importing asgi.py for its tests sets it for this process.
+            os.environ.pop('ADMISSION_THREADS', None)
+            return runpy.run_path(path)
+
+    def test_worker_models(self):
+        cores = multiprocessing.cpu_count()
+
+        gthread = self.config()
+        self.assertEqual((gthread['worker_class'], gthread['workers'],
+                          gthread['threads'], gthread['preload_app']),
+                         ('gthread', cores, 8, True))
+
+        sync = self.config(GUNICORN_WORKER_CLASS='sync', WEB_CONCURRENCY='3')
+        self.assertEqual((sync['workers'], sync['threads']), (3, 1))
+
+        gevent = self.config(GUNICORN_WORKER_CLASS='gevent')
+        self.assertFalse(gevent['preload_app'])
+
+        self.assertEqual([config['admission_threads']
+                          for config in (gthread, sync, gevent)],
+                         [8, 1, 1000])
+
+    def test_master_closes_connections_before_fork(self):
+        config = self.config()
+        wsgi = mock.Mock(app=self.app)
+
+        with mock.patch.dict(sys.modules, wsgi=wsgi), \
+                mock.patch.object(db.engine, 'dispose') as dispose:
+            config['pre_fork'](mock.Mock(), mock.Mock())
+        dispose.assert_called_once_with()
+
+        with mock.patch.object(db.engine, 'dispose') as dispose:
+            config['pre_fork'](mock.Mock(), mock.Mock())
+        dispose.assert_not_called()
+
+
+class AdmissionTestCase(LocalAgencyTestCase):
+    def setUp(self):
+        # The limits are off by default; size them as ADMISSION_CONTROL=1
+        # would for ADMISSION_THREADS=8.
+        limits = mock.patch.multiple(admission, ADMISSION_READ_LIMIT=3,
+                                     ADMISSION_WRITE_LIMIT=1)
+        limits.start()
+        self.addCleanup(limits.stop)
+        super().setUp()
+        self.seed(movies=1, actors_per_movie=1)
+        self.limiters = self.app.extensions['admission']
+
+    def test_limits_are_off_unless_turned_on(self):
+        def limits(**env):
+            env = dict({key: value for key, value in os.environ.items()
+                        if not key.startswith('ADMISSION_')}, **env)
+            output = subprocess.run(
+                [sys.executable, '-c', 'import admission as a; print('
+                 'a.ADMISSION_READ_LIMIT, a.ADMISSION_WRITE_LIMIT, '
+                 'a.ADMISSION_QUEUE_SIZE)'],
+                env=env, check=True, capture_output=True, text=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+            return [int(value) for value in output.split()]
+
+        self.assertEqual(limits()[:2], [0, 0])
+        self.assertEqual(limits(ADMISSION_CONTROL='1',
+                                ADMISSION_THREADS='32'), [12, 4, 4])
+
+    def test_limiter_queues_then_refuses(self):
+        limiter = admission.Limiter(1, queue_size=1, timeout=0.05)
+        self.assertIsNone(limiter.acquire())
+
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(limiter.acquire()))
+        waiter.start()
+        while not limiter.stats()['waiting']:
+            time.sleep(0.001)
+        self.assertEqual(limiter.acquire(), 'queue_full')
+        waiter.join()
+        self.assertEqual(results, ['timeout'])
+
+        waiter = threading.Thread(
+            target=lambda: results.append(limiter.acquire()))
+        waiter.start()
+        while not limiter.stats()['waiting']:
+            time.sleep(0.001)
+        limiter.release()
+        waiter.join()
+        self.assertEqual(results, ['timeout', None])
+        self.assertEqual(limiter.stats(),
+                         {'limit': 1, 'active': 1, 'waiting': 0})
+
+    def test_full_class_is_shed_with_503(self):
+        reads = self.limiters['read']
+        reads.active, reads.queue_size = reads.limit, 0
+
+        res = self.client().get('/actors', headers=self.headers)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(json.loads(res.data)['error'], 503)
+        res = self.client().post('/actors', headers=self.headers, json={
+            "name": "New", "age": 30, "gender": "F", "movie_id": 1})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.client().get('/test').status_code, 200)
+
+        text = self.client().get('/metrics', headers=self.headers) \
+            .get_data(as_text=True)
+        self.assertIn('admission_rejections_total{route_class="read",'
+                      'reason="queue_full"}', text)
+        self.assertIn(f'casting_admission_read_active {reads.limit}', text)
+
+        reads.active = 0
+        res = self.client().get('/actors', headers=self.headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(reads.active, 0)
+        self.assertEqual(self.limiters['write'].active, 0)
+
+    def test_sheds_before_threads_run_out(self):
+        threads = admission.ADMISSION_THREADS
+        reads, writes = self.limiters['read'], self.limiters['write']
+        self.assertLess(reads.limit + writes.limit + reads.queue_size +
+                        writes.queue_size, threads)
+
+        held = threading.Event()
+
+        @self.app.route('/test/hold', methods=['GET', 'POST'])
+        def hold():
+            if request.method == 'GET':
+                held.wait(10)
+            return jsonify({"success": True})
+
+        def call(method):
+            return self.app.test_client().open('/test/hold', method=method)
+
+        # Like a gthread worker: requests wait for one of `threads` threads.
+        pool = ThreadPoolExecutor(threads)
+        try:
+            gets = [pool.submit(call, 'GET') for _ in range(threads * 4)]
+            deadline = time.monotonic() + 5
+            while sum(f.done() for f in gets) < len(gets) - reads.limit:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+            # Reads are saturated, yet a write still finds a free thread.
+            write = pool.submit(call, 'POST')
+            self.assertEqual(write.result(timeout=2).status_code, 200)
+        finally:
+            held.set()
+            pool.shutdown()
+
+        statuses = [f.result().status_code for f in gets]
+        self.assertEqual(statuses.count(200), reads.limit)
+        self.assertEqual(statuses.count(503), len(gets) - reads.limit)
+        self.assertEqual(reads.active, 0)
+
+    def test_subject_rate_limit(self):
+        buckets = admission.TokenBuckets(rate=0.5, burst=2)
+        with mock.patch.object(admission, 'subject_buckets', buckets):
+            statuses = [self.client().get('/actors', headers=self.headers)
+                        for _ in range(3)]
+            other = self.client().get('/actors', headers={
+                "Authorization": f"Bearer {mint_token(subject='other')}"})
+
+        self.assertEqual([res.status_code for res in statuses],
+                         [200, 200, 429])
+        self.assertEqual(statuses[2].headers['Retry-After'], '2')
+        self.assertEqual(other.status_code, 200)
+        self.assertEqual(self.limiters['read'].active, 0)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,194 @@
+import socket
+import threading
+import time
+import unittest
+
+import rsa
+from jose import jwk
+
+from auth.jwks import JWKSCache
+from auth.token_cache import TokenCache
+
+
+def make_jwk(kid):
+    _, private_key = rsa.newkeys(512)
+    key = jwk.construct(private_key.save_pkcs1().decode(), 'RS256')
+    public = key.public_key().to_dict()
+    public.update({'kid': kid, 'use': 'sig'})
+    return public
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.jwks = {'keys': [make_jwk('k1')]}
+        self.max_age = None
+        self.fetches = 0
+
+    def fetch(self):
+        self.fetches += 1
+        return self.jwks, self.max_age
+
+    def test_keys_are_fetched_once(self):
+        cache = JWKSCache('https://idp/jwks.json', fetch=self.fetch)
+
+        for _ in range(10):
+            self.assertIsNotNone(cache.get_key('k1'))
+
+        self.assertEqual(self.fetches, 1)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 9)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['refreshes'], 1)
+
+    def test_cache_control_max_age_overrides_ttl(self):
+        self.max_age = 0
+        cache = JWKSCache('https://idp/jwks.json', ttl=600,
+                          fetch=self.fetch)
+
+        cache.get_key('k1')
+        cache.get_key('k1')
+
+        self.assertEqual(self.fetches, 2)
+
+    def test_short_max_age_does_not_refresh_on_every_hit(self):
+        self.max_age = 15
+        cache = JWKSCache('https://idp/jwks.json', refresh_ahead=60,
+                          fetch=self.fetch)
+        cache.get_key('k1')
+
+        for _ in range(100):
+            self.assertIsNotNone(cache.get_key('k1'))
+
+        self.assertEqual(self.fetches, 1)
+        self.assertFalse(cache.refreshing)
+
+    def test_unknown_kid_refetches_once(self):
+        cache = JWKSCache('https://idp/jwks.json', fetch=self.fetch,
+                          min_refetch_interval=0)
+        cache.get_key('k1')
+
+        self.jwks = {'keys': [make_jwk('k1'), make_jwk('k2')]}
+        self.assertIsNotNone(cache.get_key('k2'))
+        self.assertEqual(self.fetches, 2)
+
+    def test_unknown_kid_is_rate_limited(self):
+        cache = JWKSCache('https://idp/jwks.json', fetch=self.fetch,
+                          min_refetch_interval=60)
+        cache.get_key('k1')
+
+        for _ in range(5):
+            self.assertIsNone(cache.get_key('bogus'))
+
+        self.assertEqual(self.fetches, 1)
+
+    def test_concurrent_misses_share_one_fetch(self):
+        def slow_fetch():
+            time.sleep(0.05)
+            return self.fetch()
+
+        cache = JWKSCache('https://idp/jwks.json', fetch=slow_fetch)
+        threads = [
+            threading.Thread(target=cache.get_key, args=('k1',))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.fetches, 1)
+
+    def test_stale_keys_survive_idp_outage(self):
+        cache = JWKSCache('https://idp/jwks.json', ttl=0, fetch=self.fetch)
+        cache.get_key('k1')
+
+        def broken_fetch():
+            raise OSError('idp down')
+
+        cache.fetch = broken_fetch
+        self.assertIsNotNone(cache.get_key('k1'))
+        self.assertEqual(cache.stats()['errors'], 1)
+
+    def test_hung_idp_times_out_and_stale_keys_are_served(self):
+        idp = socket.socket()
+        self.addCleanup(idp.close)
+        idp.bind(('127.0.0.1', 0))
+        idp.listen()  # accepts connections, never answers
+        cache = JWKSCache('http://127.0.0.1:%d/jwks.json' %
+                          idp.getsockname()[1], ttl=0, fetch_timeout=0.2)
+        cache.fetch = self.fetch
+        cache.get_key('k1')
+        cache.fetch = cache.fetch_jwks
+
+        started = time.monotonic()
+        self.assertIsNotNone(cache.get_key('k1'))
+
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(cache.stats()['errors'], 1)
+
+    def test_rotation_notifies_listeners(self):
+        cache = JWKSCache('https://idp/jwks.json', ttl=0, fetch=self.fetch)
+        rotations = []
+        cache.on_rotate(lambda: rotations.append(True))
+        cache.get_key('k1')
+
+        self.jwks = {'keys': [make_jwk('k2')]}
+        cache.get_key('k2')
+
+        self.assertEqual(len(rotations), 1)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    def payload(self, ttl=60):
+        return {
+            'sub': 'auth0|someone',
+            'exp': time.time() + ttl,
+            'permissions': ['get:movies', 'get:actors'],
+        }
+
+    def test_hit_returns_precomputed_permissions(self):
+        cache = TokenCache(maxsize=4)
+        cache.put('token', self.payload())
+
+        decision = cache.get('token')
+
+        self.assertIsNotNone(decision)
+        self.assertEqual(decision.permissions,
+                         frozenset(['get:movies', 'get:actors']))
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_expired_tokens_are_dropped(self):
+        cache = TokenCache(maxsize=4)
+        cache.put('token', self.payload(ttl=-1))
+
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_tokens_without_exp_are_not_cached(self):
+        cache = TokenCache(maxsize=4)
+        cache.put('token', {'permissions': []})
+
+        self.assertIsNone(cache.get('token'))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = TokenCache(maxsize=2)
+        cache.put('a', self.payload())
+        cache.put('b', self.payload())
+        cache.get('a')
+        cache.put('c', self.payload())
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_clear_invalidates_everything(self):
+        cache = TokenCache(maxsize=4)
+        cache.put('a', self.payload())
+        cache.clear()
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
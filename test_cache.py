@@ -0,0 +1,93 @@
+import unittest
+
+from cache import LRUBackend, ResponseCache, SharedStoreBackend
+
+
+class FakeStore:
+    '''Stands in for a Redis client'''
+
+    def __init__(self):
+        self.values = {}
+        self.sets = {}
+        self.ttls = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+        self.ttls[key] = ex
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(members)
+
+    def expire(self, key, seconds):
+        self.ttls[key] = seconds
+
+    def smembers(self, key):
+        return set(self.sets.get(key, ()))
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+            self.sets.pop(key, None)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def backends(self):
+        return [LRUBackend(), SharedStoreBackend(FakeStore())]
+
+    def test_read_through_counts_hits(self):
+        for backend in self.backends():
+            cache = ResponseCache(backend)
+            self.assertIsNone(cache.get('/movies'))
+            cache.set('/movies', b'[]', ('movies',))
+            self.assertEqual(cache.get('/movies'), b'[]')
+
+            stats = cache.stats()
+            self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+            self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_invalidation_only_drops_tagged_keys(self):
+        for backend in self.backends():
+            cache = ResponseCache(backend)
+            cache.set('/movies', b'm', ('movies', 'actors'))
+            cache.set('/actors', b'a', ('actors',))
+            cache.set('/other', b'o', ('movies',))
+
+            cache.invalidate({'actors'})
+
+            self.assertIsNone(cache.get('/movies'))
+            self.assertIsNone(cache.get('/actors'))
+            self.assertEqual(cache.get('/other'), b'o')
+
+    def test_shared_store_keys_all_expire(self):
+        store = FakeStore()
+        cache = ResponseCache(SharedStoreBackend(store, ttl=60))
+        cache.set('/movies', b'm', ('movies', 'actors'))
+        cache.set('/actors', b'a', ('actors',))
+
+        self.assertEqual(set(store.ttls), set(store.values) | set(store.sets))
+        self.assertEqual(set(store.ttls.values()), {60})
+
+    def test_lru_is_bounded_by_bytes(self):
+        backend = LRUBackend(max_bytes=20)
+        backend.set('a', b'x' * 9, ())
+        backend.set('b', b'x' * 9, ())
+        backend.get('a')
+        backend.set('c', b'x' * 9, ())
+
+        self.assertIsNotNone(backend.get('a'))
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.stats()['bytes'], 20)
+        self.assertEqual(backend.stats()['evictions'], 1)
+
+    def test_disabled_cache_never_hits(self):
+        cache = ResponseCache(None)
+        cache.set('/movies', b'[]', ('movies',))
+
+        self.assertIsNone(cache.get('/movies'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+"""Warm-up run once per worker before it takes traffic.
+
+Without it the first requests a worker serves pay for fetching the IdP
+signing keys, opening database connections and compiling SQL. warm_up()
+does that work up front:
+
+- fetches the JWKS, so the first token check is a cache hit;
+- opens WARMUP_CONNECTIONS pooled connections (at most the pool size) to
+  the primary and to each read replica, and returns them to the pool;
+- runs the statements behind the list, detail and ETag paths once, which
+  configures the mappers and fills SQLAlchemy's compiled statement cache.
+
+A step that fails is logged and skipped: a worker that could not warm up
+still serves, only more slowly at first. Set WARMUP=0 to turn it off.
+"""
+import os
+import time
+
+from sqlalchemy.orm import configure_mappers, selectinload
+from sqlalchemy.pool import QueuePool
+
+from auth.auth import jwks_cache
+from models import db, Movie, Actor, get_versions
+
+
+WARMUP = os.getenv('WARMUP', '1') == '1'
+WARMUP_CONNECTIONS = int(os.getenv('WARMUP_CONNECTIONS', 2))
+
+
+def prefetch_keys():
+    jwks_cache.refresh()
+
+
+def open_connections(engine, count=WARMUP_CONNECTIONS):
+    '''Opens up to `count` connections at once and checks them back in,
+    leaving them idle in the pool'''
+    if isinstance(engine.pool, QueuePool):
+        count = min(count, engine.pool.size())
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def compile_queries():
+    '''Runs each hot statement once, in the same shape the routes build
+    it, so later executions reuse the compiled form'''
+    configure_mappers()
+    get_versions(Movie.__tablename__, Actor.__tablename__)
+    first = {}
+    for model in (Movie, Actor):
+        query = model.row_query()
+        rows = query.order_by(model.id).limit(1).all()
+        query.filter(model.id > 0).order_by(model.id).limit(1).all()
+        model.format_rows(rows)
+        first[model] = rows[0].id if rows else 0
+    # A movie has to be found for its actors' selectin query to run.
+    Movie.query.options(selectinload(Movie.actors)) \
+        .filter(Movie.id == first[Movie]).one_or_none()
+    Actor.query.get(first[Actor])
+
+
+def app_engines(app):
+    '''The primary engine of `app` followed by its replica engines'''
+    engines = [db.get_engine(app)]
+    if 'replicas' in app.extensions:
+        engines += app.extensions['replicas'].engines
+    return engines
+
+
+def warm_up(app):
+    '''Warms `app` up, returns the seconds each step took'''
+    if not WARMUP:
+        return {}
+
+    def connections():
+        for engine in app_engines(app):
+            open_connections(engine)
+
+    timings = {}
+    with app.app_context():
+        for name, step in (('jwks', prefetch_keys),
+                           ('connections', connections),
+                           ('queries', compile_queries)):
+            started = time.perf_counter()
+            try:
+                step()
+            except Exception:
+                app.logger.warning('warm-up step %s failed', name,
+                                   exc_info=True)
+            timings[name] = time.perf_counter() - started
+        db.session.remove()
+    return timings
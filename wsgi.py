@@ -0,0 +1,14 @@
+"""WSGI entry point for the casting API.
+
+    gunicorn wsgi:app
+
+Importing app.py builds nothing; this module is what creates the app,
+and it warms the app up (see warmup.py) before the server hands it
+requests.
+"""
+from app import create_app
+from warmup import warm_up
+
+
+app = create_app()
+warm_up(app)